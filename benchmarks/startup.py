@@ -0,0 +1,71 @@
+"""
+Startup benchmark of the pseek command line, based on python -X importtime.
+
+Runs a name search in an empty directory several times and reports the median import time of pseek with the
+slowest modules. It fails (exit code 1) if a module that should only be imported by some options is imported
+by a plain search, or if the median import time is over the budget given with --max-ms.
+
+Usage:
+    python benchmarks/startup.py [--runs 10] [--max-ms 150] [--top 15]
+"""
+import sys, argparse, tempfile, statistics, subprocess
+from pathlib import Path
+
+# Modules that a plain name search must not import (archive backends, --expr, --fuzzy, --server, --jobs)
+LAZY_MODULES = (
+    'py7zr', 'rarfile', 'zipfile', 'tarfile', 'pseek.archives', 'lark', 'pseek.grammar', 'rapidfuzz',
+    'concurrent.futures', 'pseek.cache', 'pseek.server', 'socketserver', 'multiprocessing'
+)
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def run_once(directory: str) -> dict:
+    """Run a name search with -X importtime and return module name -> (self us, cumulative us)"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'pseek.cli', 'pseek-startup-benchmark', '-f', '-p', directory],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Measure the import time of the pseek command line.')
+    arg_parser.add_argument('--runs', type=int, default=10, help='Number of runs (the median is reported).')
+    arg_parser.add_argument('--max-ms', type=float, help='Fail if the median import time is over this (ms).')
+    arg_parser.add_argument('--top', type=int, default=15, help='Number of slowest modules to show.')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        runs = [run_once(directory) for _ in range(args.runs)]
+
+    # The first import of the pseek package includes every pseek module and their dependencies
+    totals = [modules['pseek'][1] / 1000 for modules in runs]
+    total = statistics.median(totals)
+    print(f'pseek import time: median {total:.1f} ms, min {min(totals):.1f} ms, max {max(totals):.1f} ms '
+          f'({args.runs} runs)\n')
+
+    print('Slowest modules (self time, median):')
+    self_times = {name: statistics.median(modules.get(name, (0, 0))[0] for modules in runs) for name in runs[0]}
+    for name, self_us in sorted(self_times.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {self_us / 1000:8.2f} ms  {name}')
+
+    failed = False
+    imported = sorted(name for name in runs[0] if name.split('.')[0] in LAZY_MODULES or name in LAZY_MODULES)
+    if imported:
+        print(f'\nFAIL: a plain search imported modules that should be imported lazily: {", ".join(imported)}')
+        failed = True
+    if args.max_ms is not None and total > args.max_ms:
+        print(f'\nFAIL: the median import time ({total:.1f} ms) is over the budget ({args.max_ms:.1f} ms)')
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
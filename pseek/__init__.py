@@ -0,0 +1,3 @@
+from .api import SearchOptions, search, NameMatch, LineMatch, ContentMatch, Coverage
+
+__all__ = ['SearchOptions', 'search', 'NameMatch', 'LineMatch', 'ContentMatch', 'Coverage']
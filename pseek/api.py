@@ -0,0 +1,109 @@
+from pathlib import Path
+from dataclasses import dataclass
+from .searcher import Search
+from .results import NameMatch, LineMatch, ContentMatch, Coverage
+
+# Search types in the order of the command line output
+SEARCH_TYPES = ('file', 'directory', 'content')
+
+
+@dataclass
+class SearchOptions:
+    """
+    Query and options of a search. The options are the same as the command line options (see pseek --help),
+    types selects the search types ('file', 'directory' and 'content'). If timeout (seconds) is set, the search
+    stops cleanly when it has passed.
+    """
+    query: str
+    path: Path = Path('.')
+    types: tuple = SEARCH_TYPES
+    case_sensitive: bool = False
+    regex: bool = False
+    whole_word: bool = False
+    expr: bool = False
+    fuzzy: bool = False
+    fuzzy_level: int = 80
+    ext: tuple = ()
+    exclude_ext: tuple = ()
+    include: tuple = ()
+    exclude: tuple = ()
+    re_include: str = None
+    re_exclude: str = None
+    max_size: float = None
+    min_size: float = None
+    encoding: str = 'utf-8'
+    errors: str = 'replace'
+    archive: bool = False
+    depth: int = None
+    arc_ext: tuple = ()
+    arc_ee: tuple = ()
+    arc_inc: tuple = ()
+    arc_exc: tuple = ()
+    arc_max: float = None
+    arc_min: float = None
+    arc_cache: bool = False
+    jobs: int = None
+    full_path: bool = False
+    no_content: bool = False
+    timeout: float = None
+
+    def create_search(self) -> Search:
+        """Return a Search instance with these options"""
+        return Search(
+            base_path=self.path,
+            query=self.query,
+            case_sensitive=self.case_sensitive,
+            ext=self.ext,
+            exclude_ext=self.exclude_ext,
+            regex=self.regex,
+            include=self.include,
+            exclude=self.exclude,
+            re_include=self.re_include,
+            re_exclude=self.re_exclude,
+            whole_word=self.whole_word,
+            expr=self.expr,
+            fuzzy=self.fuzzy,
+            fuzzy_level=self.fuzzy_level,
+            max_size=self.max_size,
+            min_size=self.min_size,
+            archive=self.archive,
+            depth=self.depth,
+            arc_ext=self.arc_ext,
+            arc_ee=self.arc_ee,
+            arc_inc=self.arc_inc,
+            arc_exc=self.arc_exc,
+            arc_max=self.arc_max,
+            arc_min=self.arc_min,
+            full_path=self.full_path,
+            no_content=self.no_content,
+            jobs=self.jobs,
+            arc_cache=self.arc_cache,
+            encoding=self.encoding,
+            errors=self.errors,
+            timeout=self.timeout
+        )
+
+
+def search(options: SearchOptions):
+    """
+    Search lazily: results are yielded as soon as they are found, and the search stops when the generator
+    is closed. Results of different search types may be mixed. To know how much of the tree a search with a
+    timeout covered, iterate options.create_search().iter_search(*options.types) instead and read the coverage
+    attribute of the Search instance (a Coverage record) at the end.
+
+    Example:
+        for match in search(SearchOptions('TODO', 'src', types=('content',))):
+            for line in match.lines:
+                print(match.label, line.line_num, line.text)
+
+    Yields:
+        NameMatch | ContentMatch: each result (see results.py)
+
+    Raises:
+        ValueError: if the query or a regex option can't be parsed, or if the encoding can't be used for
+            content search (it must be ASCII-compatible)
+    """
+    yield from options.create_search().iter_search(*options.types)
+
+
+__all__ = ['SearchOptions', 'search', 'NameMatch', 'LineMatch', 'ContentMatch', 'Coverage', 'SEARCH_TYPES']
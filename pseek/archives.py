@@ -0,0 +1,109 @@
+import os, tempfile, tarfile, gzip, bz2, lzma
+from py7zr.io import Py7zIO, WriterFactory
+from .utils import SPOOL_MAX_SIZE
+
+# Magic bytes of the compressed tar formats and their decompression stream (see open_tar)
+TAR_COMPRESSIONS = {b'\x1f\x8b': gzip.open, b'BZh': bz2.open, b'\xfd7zXZ\x00': lzma.open}
+
+
+class SpooledIO(Py7zIO):
+    """
+    py7zr writer that stores an extracted 7z member in a temporary file. Members of one extraction are kept
+    in memory while their total size fits in SPOOL_MAX_SIZE (tracked by the factory), the rest go to disk.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.in_memory = True
+        # max_size=0: rolling over to disk is decided in write
+        self.file = tempfile.SpooledTemporaryFile(max_size=0)
+
+    def write(self, s) -> int:
+        if self.in_memory:
+            if self.factory.memory_size + len(s) > SPOOL_MAX_SIZE:
+                self.file.rollover()
+                self.in_memory = False
+            else:
+                self.factory.memory_size += len(s)
+        return self.file.write(s)
+
+    def read(self, size=None) -> bytes:
+        return self.file.read(-1 if size is None else size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def size(self) -> int:
+        pos = self.file.tell()
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(pos)
+        return size
+
+
+class SpooledIOFactory(WriterFactory):
+    """py7zr writer factory that spools every extracted member (see SpooledIO)"""
+
+    def __init__(self):
+        self.products = {}
+        self.memory_size = 0
+
+    def create(self, filename: str) -> Py7zIO:
+        product = SpooledIO(self)
+        self.products[filename] = product
+        return product
+
+
+def read_7z_members(archive, filenames: list) -> dict:
+    """
+    Extract members of an open 7z archive to spooled temporary files with a single pass over the archive,
+    so each solid block is decompressed only once.
+
+    Returns:
+        dict: member name to its rewound file (members without content are missing)
+    """
+    if not filenames:
+        return {}
+
+    factory = SpooledIOFactory()
+    archive.extract(targets=filenames, factory=factory)
+    # The archive must be rewound before the next extraction
+    archive.reset()
+
+    members = {}
+    for filename, product in factory.products.items():
+        product.seek(0)
+        members[filename] = product.file
+    return members
+
+
+def open_tar(file_stream):
+    """
+    Open a tar archive for a single sequential pass (see iter_tar_members). Compressed archives are read
+    through a forward-only decompression stream, so the archive is decompressed only once.
+    tarfile's own stream mode ('r|*') does the same but decompresses in small pieces in Python, which is slower.
+    The compression is detected from the magic bytes like tarfile's 'r' mode, not from the extension, so for
+    example a gzip-compressed file named .tar is still read.
+    """
+    start = file_stream.tell()
+    head = file_stream.read(len(max(TAR_COMPRESSIONS, key=len)))
+    file_stream.seek(start)
+    opener = next((opener for magic, opener in TAR_COMPRESSIONS.items() if head.startswith(magic)), None)
+    return tarfile.open(fileobj=opener(file_stream, 'rb') if opener else file_stream, mode='r:')
+
+
+def iter_tar_members(tf):
+    """
+    Iterate over the members of a tar archive in order, without getmembers() (which reads the whole archive
+    before the first member can be used). Each member must be extracted before the next one is requested,
+    or reading it would seek back and decompress again. TarFile keeps every header it reads (tf.members),
+    which is not needed for a single pass, so they are dropped to keep memory flat.
+    """
+    while True:
+        member = tf.next()
+        if member is None:
+            return
+        tf.members.clear()
+        yield member
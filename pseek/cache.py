@@ -0,0 +1,158 @@
+import os, pickle, hashlib, tempfile, shutil
+from pathlib import Path
+from .scanner import BINARY_SNIFF_SIZE, is_binary
+from .utils import USER_CACHE_DIR
+
+# Directory of the archive content cache
+CACHE_DIR = USER_CACHE_DIR / 'archives'
+CACHE_VERSION = 2
+# Least recently used entries are removed when the cache grows larger than this
+CACHE_MAX_SIZE = 1024 * 1_048_576
+ENTRY_SUFFIX = '.entry'
+
+
+class CachedMember:
+    """Read-only binary stream of a member stored in a cache entry"""
+
+    def __init__(self, f, offset: int, size: int):
+        self.f = f
+        self.pos = offset
+        self.end = offset + size
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.end - self.pos
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        self.f.seek(self.pos)
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+
+class ArchiveCache:
+    """
+    On-disk cache of the content of archive files, so repeated searches don't decompress them again.
+
+    Each archive is stored in one entry file: the members that passed the archive filters one after
+    another, then a pickled list of (member_path, offset, size) and the offset of that list (8 bytes).
+    Entries are keyed by the archive path, size, mtime and the filters, so a changed archive gets a new
+    entry and the old one is removed with the least recently used entries when the cache is full.
+    """
+
+    def __init__(self, directory: Path = CACHE_DIR, max_size: int = CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, p_resolved: Path, filters: tuple):
+        """Return the entry key of an archive, or None if it can't be read"""
+        try:
+            stat = p_resolved.stat()
+        except OSError:
+            return None
+        data = repr((CACHE_VERSION, str(p_resolved), stat.st_size, stat.st_mtime_ns, filters))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        Open a cached archive.
+
+        Returns:
+            iterator | None: (member_path, CachedMember) of each member, or None if the archive is not cached
+        """
+        path = self.directory / (key + ENTRY_SUFFIX)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+
+        try:
+            f.seek(-8, os.SEEK_END)
+            f.seek(int.from_bytes(f.read(8), 'little'))
+            members = pickle.load(f)
+            # Mark the entry as recently used
+            os.utime(path)
+        except Exception:
+            f.close()
+            return None
+
+        return self.iter_members(f, members)
+
+    @staticmethod
+    def iter_members(f, members: list):
+        """Yield (member_path, CachedMember) of each member of an open entry file and close it at the end"""
+        with f:
+            for member_path, offset, size in members:
+                yield member_path, CachedMember(f, offset, size)
+
+    def put(self, key: str, members) -> bool:
+        """
+        Store the (member_path, stream) members of an archive (except binary ones). The entry is written to a temporary
+        file and renamed, so searches running at the same time never read a partial entry.
+        The new entry is never evicted by its own put, so the cache can be larger than max_size
+        by at most one entry. Returns True if the entry was stored, and False if the entry or the archive (e.g. a
+        corrupt member) can't be read, in which case nothing is left in the cache directory.
+        """
+        tmp_path = None
+        try:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                index = []
+                for member_path, stream in members:
+                    head = stream.read(BINARY_SNIFF_SIZE)
+                    # Binary members are never searched, so they are not stored
+                    if is_binary(head):
+                        continue
+
+                    offset = f.tell()
+                    f.write(head)
+                    shutil.copyfileobj(stream, f)
+                    index.append((member_path, offset, f.tell() - offset))
+
+                index_offset = f.tell()
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(index_offset.to_bytes(8, 'little'))
+
+            os.replace(tmp_path, self.directory / (key + ENTRY_SUFFIX))
+        except Exception:
+            # Reading a member can fail with any error of its archive module (BadZipFile, EOFError, LZMAError...)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        self.evict(key)
+        return True
+
+    def remove(self, key: str):
+        """Remove an entry (for example one that was stored from an archive that was not read to the end)"""
+        try:
+            os.remove(self.directory / (key + ENTRY_SUFFIX))
+        except OSError:
+            pass
+
+    def evict(self, keep: str = None):
+        """Remove the least recently used entries (except keep) until the cache fits in max_size"""
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(ENTRY_SUFFIX):
+                        continue
+                    stat = entry.stat()
+                    total += stat.st_size
+                    if entry.name != f'{keep}{ENTRY_SUFFIX}':
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Removed by another search
+            total -= size
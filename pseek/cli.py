@@ -1,27 +1,130 @@
-import click
+import sys, click
+from pathlib import Path
 from .searcher import Search
-from multiprocessing import Process
-from .utils import check_rar_backend
+from .index import TrigramIndex
+from .parser import highlight_spans
+from .results import ContentMatch
+from .utils import check_rar_backend, check_encoding
 
+# Matching lines are displayed in blocks of about this many characters (see echo_result)
+ECHO_BLOCK_SIZE = 1_048_576
 
-def run_search_process(file, directory, content, search_instance):
+
+def format_line(line) -> str:
+    """Format a LineMatch for display, with the matching parts highlighted"""
+    # Show a note if the pattern repeats 3 or more times
+    count_query = f' - Repeated {line.count} times' if line.count >= 3 else ''
+    return click.style(f'Line {line.line_num}{count_query}: ', fg='magenta') + highlight_spans(line.text, line.spans)
+
+
+def format_result(result) -> str:
+    """Format a NameMatch or ContentMatch for display, with the matching parts highlighted"""
+    if isinstance(result, ContentMatch):
+        label = click.style(result.label, fg='cyan')
+        if not result.lines:
+            return label
+        return label + '\n' + '\n'.join(map(format_line, result.lines)) + '\n'
+
+    highlighted_name = highlight_spans(result.name, result.spans)
+    if not result.member_path:
+        return f'{result.path.parent}\\{highlighted_name}'
+
+    # Name inside an archive file, e.g. dir\a.zip::b.7z::sub\c.txt
+    *parents, member = result.member_path
+    label = '::'.join((result.path.name, *parents, str(Path(member).parent)))
+    return f'{result.path.parent}\\{label}\\{highlighted_name}'
+
+
+def echo_result(result) -> int:
+    """
+    Display a single result (a name, a file path or a file path with its matching lines).
+    Returns the count of results.
+    """
+    if isinstance(result, ContentMatch) and result.lines:
+        # Display the lines in blocks, so the output of many or very long lines is not built as one string
+        click.echo(click.style(result.label, fg='cyan'))
+        block, size = [], 0
+        for line in result.lines:
+            block.append(format_line(line))
+            size += len(block[-1])
+            if size >= ECHO_BLOCK_SIZE:
+                click.echo('\n'.join(block))
+                block, size = [], 0
+        # The lines of a file are followed by an empty line
+        click.echo('\n'.join(block + ['']))
+        # Each matching line of a file is a result
+        return len(result.lines)
+
+    click.echo(format_result(result))
+    return 1
+
+
+def echo(title: str, search_type: str, results: list) -> int:
+    """
+    Display the results of a search type with a title.
+    Returns the count of results.
+    """
+    count_result = 0
+    if results:
+        click.echo(click.style(f'\n{title}:\n', fg='yellow'))
+        for result in results:
+            count_result += echo_result(result)
+
+        if count_result >= 3:
+            click.echo(click.style(f'\n{count_result} results found for {search_type}', fg='blue'))
+
+    return count_result
+
+
+def run_search_process(file, directory, content, search_instance, stream=False):
     """Performs the basic search operation"""
     total_results = 0
+    search_types = [t for t, enabled in (('file', file), ('directory', directory), ('content', content)) if enabled]
+
+    if stream:
+        # Display every result as soon as it is found
+        titles = {'file': 'Files', 'directory': 'Directories', 'content': 'Contents'}
+        counts = dict.fromkeys(search_types, 0)
+        current_type = None
+
+        for result in search_instance.iter_search(*search_types):
+            # Results of different types can be mixed, so show the title whenever the type changes
+            if result.search_type != current_type:
+                current_type = result.search_type
+                click.echo(click.style(f'\n{titles[current_type]}:\n', fg='yellow'))
+            counts[current_type] += echo_result(result)
+
+        for search_type, count in counts.items():
+            if count >= 3:
+                click.echo(click.style(f'\n{count} results found for {search_type}', fg='blue'))
+        total_results = sum(counts.values())
+    else:
+        # Walk the tree once for all requested search types
+        results = search_instance.search(*search_types).result
 
-    # Search for files if requested.
-    if file:
-        total_results += search_instance.search('file').echo('Files', 'file')
-    # Search for directories if requested and extension filters are not active.
-    if directory:
-        total_results += search_instance.search('directory').echo('Directories', 'directory')
-    # Search for content inside files if requested.
-    if content:
-        total_results += search_instance.search('content').echo('Contents', 'content')
+        # Display files if requested.
+        if file:
+            total_results += echo('Files', 'file', results['file'])
+        # Display directories if requested and extension filters are not active.
+        if directory:
+            total_results += echo('Directories', 'directory', results['directory'])
+        # Display content inside files if requested.
+        if content:
+            total_results += echo('Contents', 'content', results['content'])
 
     # Display final summary message.
     message = f'\nTotal results: {total_results}' if total_results else 'No results found'
     click.echo(click.style(message, fg='red'))
 
+    # Tell how much of the tree was searched if the timeout stopped the search
+    coverage = search_instance.coverage
+    if coverage is not None and not coverage.complete:
+        message = f'{coverage.paths} paths walked'
+        if coverage.files:
+            message += f', {coverage.searched} of {coverage.files} files searched for content'
+        click.echo(click.style(f'\nTimeout! Search exceeded {search_instance.timeout} seconds and was stopped: '
+                               f'{message}', fg='red'))
+
 
 @click.command()
 @click.argument('query')
@@ -51,7 +154,8 @@ def run_search_process(file, directory, content, search_instance):
                    'r, c, w, f, rc, cr, cw, wc, cf, fc, wf, fw, cwf, cfw, wcf, wfc, fcw, fwc. '
                    'Examples: r"foo.*bar", wcf"Aple", cr".*Foo", ...)')
 @click.option('--timeout', type=click.INT,
-              help='To stop the search after a specified period of time (Seconds)')
+              help='To stop the search after a specified period of time (Seconds). '
+                   'The results found until then are displayed with how much of the tree was searched.')
 @click.option('--fuzzy', is_flag=True, help='Enable fuzzy search (approximate matching). '
               'except when --expr is enabled, '
               'in which case you can make it fuzzy by putting f before term: f"foo"')
@@ -74,6 +178,11 @@ def run_search_process(file, directory, content, search_instance):
 # Size filters
 @click.option('--max-size', type=click.FLOAT, help='Maximum file/directory size (in MB).')
 @click.option('--min-size', type=click.FLOAT, help='Minimum file/directory size (in MB).')
+@click.option('--encoding', default='utf-8', show_default=True,
+              help='Encoding of the files for content search (must be ASCII-compatible).')
+@click.option('--errors', type=click.Choice(['replace', 'strict', 'ignore', 'backslashreplace']),
+              default='replace', show_default=True,
+              help="How to show bytes that can't be decoded in matching lines ('strict' skips those lines).")
 # Archive options
 @click.option('--archive', is_flag=True,
               help='Enable search within archive files (e.g. zip, rar, 7z, gz, bz2, xz, tar, tar.gz, tar.bz2, tar.xz)')
@@ -89,86 +198,160 @@ def run_search_process(file, directory, content, search_instance):
               multiple=True, help='Directories or files to exclude from search for inside archive files.')
 @click.option('--arc-max', type=click.FLOAT, help='Maximum size of files in the archive (in MB).')
 @click.option('--arc-min', type=click.FLOAT, help='Minimum size of files in the archive (in MB).')
+@click.option('--arc-cache', is_flag=True,
+              help='Cache the content of archive files on disk (in ~/.cache/pseek) so repeated content searches '
+                   'of the same archives skip decompression.')
 @click.option('--rarfb', type=click.Path(exists=True, file_okay=True, dir_okay=False),
               help='Path to RAR backend tool (e.g. UnRAR.exe, ...). '
                    'Enter the file type in the query (e.g. unrar, bsdtar, unar, 7z).')
+# Performance options
+@click.option('-j', '--jobs', type=click.IntRange(min=0),
+              help='Use this many worker processes for content search instead of threads '
+                   '(0 means the number of CPUs). Useful for regex, expression and fuzzy searches.')
+@click.option('--server', is_flag=True,
+              help='Run the search in a running search server (see pseek serve start), which keeps the walked tree, '
+                   'compiled queries and indexes in memory between searches.')
 # Output option
 @click.option('--full-path', is_flag=True, help='Display full paths for results.')
 @click.option('--no-content', is_flag=True, help='Only display files path for content search.')
+@click.option('--stream', is_flag=True,
+              help='Display results as soon as they are found instead of after the search ends '
+                   '(results of different search types may be mixed).')
 def search(query, path, file, directory, content, case_sensitive, ext, exclude_ext, regex, include, exclude,
-           re_include, re_exclude, word, expr, timeout, fuzzy, fuzzy_level, max_size, min_size, archive, depth,
-           arc_ext, arc_ee, arc_inc, arc_exc, arc_max, arc_min, rarfb, full_path, no_content):
+           re_include, re_exclude, word, expr, timeout, fuzzy, fuzzy_level, max_size, min_size, encoding, errors,
+           archive, depth, arc_ext, arc_ee, arc_inc, arc_exc, arc_max, arc_min, arc_cache, rarfb, jobs, server,
+           full_path, no_content, stream):
     """Search for files, directories, and file content based on the query."""
 
     check_rar_backend(archive, rarfb, query)
+    check_encoding(encoding)
 
-    if not expr and fuzzy:
-        if not word:
-            click.echo(
-                click.style(
-                    "Warning: Fuzzy substring highlighting and counting matches are disabled to improve performance.\n",
-                    fg="yellow"
-                )
-            )
-        elif word and " " in query:
-            click.echo(
-                click.style(
-                    'Warning: When using "--fuzzy" and "--word", it is better to have the query be a word and '
-                    'not a phrase, as this will cause errors in the results.\n',
-                    fg="yellow"
-                )
+    if not expr and fuzzy and word and " " in query:
+        click.echo(
+            click.style(
+                'Warning: When using "--fuzzy" and "--word", it is better to have the query be a word and '
+                'not a phrase, as this will cause errors in the results.\n',
+                fg="yellow"
             )
+        )
 
     # If no search type is specified, search in all types.
     if not any((file, directory, content)):
         file = directory = content = True
 
     # Initialize the Search class with provided options.
-    search_instance = Search(
-        base_path=path,
-        query=query,
-        case_sensitive=case_sensitive,
-        ext=ext,
-        exclude_ext=exclude_ext,
-        regex=regex,
-        include=include,
-        exclude=exclude,
-        re_include=re_include,
-        re_exclude=re_exclude,
-        whole_word=word,
-        expr=expr,
-        fuzzy=fuzzy,
-        fuzzy_level=fuzzy_level,
-        max_size=max_size,
-        min_size=min_size,
-        archive=archive,
-        depth=depth,
-        arc_ext=arc_ext,
-        arc_ee=arc_ee,
-        arc_inc=arc_inc,
-        arc_exc=arc_exc,
-        arc_max=arc_max,
-        arc_min=arc_min,
-        full_path=full_path,
-        no_content=no_content
-    )
-
-    # Stop search if it exceeds timeout with multiprocessing
-    if timeout:
-        p = Process(
-            target=run_search_process,
-            args=(file, directory, content, ext, exclude_ext, search_instance)
+    search_class = Search
+    if server:
+        from .server import RemoteSearch
+        search_class = RemoteSearch
+
+    try:
+        search_instance = search_class(
+            base_path=path,
+            query=query,
+            case_sensitive=case_sensitive,
+            ext=ext,
+            exclude_ext=exclude_ext,
+            regex=regex,
+            include=include,
+            exclude=exclude,
+            re_include=re_include,
+            re_exclude=re_exclude,
+            whole_word=word,
+            expr=expr,
+            fuzzy=fuzzy,
+            fuzzy_level=fuzzy_level,
+            max_size=max_size,
+            min_size=min_size,
+            archive=archive,
+            depth=depth,
+            arc_ext=arc_ext,
+            arc_ee=arc_ee,
+            arc_inc=arc_inc,
+            arc_exc=arc_exc,
+            arc_max=arc_max,
+            arc_min=arc_min,
+            full_path=full_path,
+            no_content=no_content,
+            jobs=jobs,
+            arc_cache=arc_cache,
+            encoding=encoding,
+            errors=errors,
+            timeout=timeout
         )
-        p.start()
-        p.join(timeout)
+        run_search_process(file, directory, content, search_instance, stream)
+    except ValueError as e:
+        # The query, a regex or an option is not valid
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+
+
+@click.group()
+def serve():
+    """Run the search server used by searches with --server."""
+
+
+@serve.command()
+@click.option('--socket', 'socket_path',
+              help='Unix socket to listen on (default: $PSEEK_SOCKET, or pseek.sock in $XDG_RUNTIME_DIR '
+                   'or in the cache directory of pseek).')
+@click.option('--poll', is_flag=True,
+              help='Walk the searched trees again every few seconds to find changes instead of watching them '
+                   'with inotify.')
+def start(socket_path, poll):
+    """
+    Start a search server. Searches with --server run in it and reuse its walked trees, compiled queries and
+    indexes, which are kept up to date as files change.
+    """
+    from .server import SOCKET_PATH, run_server
+
+    run_server(socket_path or SOCKET_PATH, poll)
+
+
+@click.group()
+def index():
+    """Manage the content search index of a directory tree (used automatically by content searches)."""
+
+
+@index.command()
+@click.argument('path', type=click.Path(exists=True, file_okay=False, dir_okay=True), default='.')
+def build(path):
+    """Build the content search index of PATH."""
+    tree_index = TrigramIndex.build(Path(path))
+    tree_index.save()
+    click.secho(f'Indexed {len(tree_index.files)} files in {tree_index.root}', fg='green')
+
+
+@index.command()
+@click.argument('path', type=click.Path(exists=True, file_okay=False, dir_okay=True), default='.')
+def update(path):
+    """Update the content search index of PATH (only new and changed files are read)."""
+    tree_index = TrigramIndex.load(Path(path).resolve())
+    if tree_index is None:
+        # There is no index (or it is from an older version), build a new one
+        tree_index = TrigramIndex.build(Path(path))
+        tree_index.save()
+        click.secho(f'Indexed {len(tree_index.files)} files in {tree_index.root}', fg='green')
+        return
+
+    indexed, removed = tree_index.update()
+    tree_index.save()
+    click.secho(f'Index updated: {indexed} files indexed, {removed} files removed ({len(tree_index.files)} in total)',
+                fg='green')
+
 
-        if p.is_alive():
-            p.terminate()
-            p.join()
-            click.echo(click.style(f"\nTimeout! Search exceeded {timeout} seconds and was stopped.", fg="red"))
+def main():
+    """
+    Entry point: run the index subcommands (pseek index build/update), the search server (pseek serve start)
+    or a search. A query that is only "index" or "serve" is a search.
+    """
+    if sys.argv[1:2] == ['index'] and sys.argv[2:3] and sys.argv[2] in (*index.commands, '--help'):
+        index(args=sys.argv[2:], prog_name='pseek index')
+    elif sys.argv[1:2] == ['serve'] and sys.argv[2:3] and sys.argv[2] in (*serve.commands, '--help'):
+        serve(args=sys.argv[2:], prog_name='pseek serve')
     else:
-        run_search_process(file, directory, content, search_instance)
+        search()
 
 
 if __name__ == "__main__":
-    search()
+    main()
@@ -0,0 +1,86 @@
+import sys, functools
+from lark import Lark, Transformer, __version__ as lark_version
+from .parser import TermNode, AndNode, OrNode, NotNode
+from .utils import user_cache_dir
+
+# Lark grammar for parsing logical expressions
+query_grammar = r"""
+?start: expr
+
+?expr: or_expr
+
+?or_expr: and_expr
+        | or_expr "or" and_expr     -> or_expr
+
+?and_expr: not_expr
+         | and_expr "and" not_expr  -> and_expr
+
+?not_expr: "not" not_expr           -> not_expr
+         | term
+
+?term: PREFIXED_STRING          -> prefixed_string
+     | ESCAPED_STRING           -> string
+     | "(" expr ")"
+
+PREFIXED_STRING: /(r|c|w|f|rc|cr|cw|wc|cf|fc|wf|fw|cwf|cfw|wcf|wfc|fcw|fwc)"([^"\\]|\\.)*"/
+
+%import common.ESCAPED_STRING
+%import common.WS
+%ignore WS
+"""
+
+
+class TreeToExpr(Transformer):
+    """Transform parsed tree into expression tree (ExprNode subclasses)"""
+    def __init__(self, fuzzy_level):
+        super().__init__()
+        self.fuzzy_level = fuzzy_level
+
+    def string(self, s):
+        """ Match normal quoted string: "foo" """
+        term = s[0][1:-1]  # Remove surrounding quotes (e.g., "foo" -> foo)
+        return TermNode(
+            term,
+            False,
+            False,
+            False,
+            False,
+            None
+        )
+
+    def prefixed_string(self, s):
+        text = str(s[0])  # e.g., 'rc"pattern"'
+        prefix = text.split('"', 1)[0].lower()
+        content = text.split('"', 1)[1][:-1]
+
+        return TermNode(
+            content,
+            regex='r' in prefix,
+            whole_word='w' in prefix,
+            case_sensitive='c' in prefix,
+            fuzzy='f' in prefix,
+            fuzzy_level=self.fuzzy_level
+        )
+
+    def and_expr(self, args):
+        return AndNode(args[0], args[1])
+
+    def or_expr(self, args):
+        return OrNode(args[0], args[1])
+
+    def not_expr(self, args):
+        return NotNode(args[0])
+
+
+@functools.lru_cache(maxsize=None)
+def get_query_parser() -> Lark:
+    """
+    Build the Lark parser of the query grammar once. Its LALR tables are cached on disk by Lark, so later runs
+    load them instead of analyzing the grammar again. Lark pickles the cache, so it is kept in the private
+    cache directory of the user (see user_cache_dir), never in the shared temporary directory.
+    """
+    try:
+        cache = str(user_cache_dir() / f'query_parser-lark{lark_version}-py{sys.version_info[0]}{sys.version_info[1]}')
+    except OSError:
+        cache = False  # Build the parser without caching it
+    return Lark(query_grammar, parser="lalr", cache=cache)
@@ -0,0 +1,277 @@
+import os, sys, json, threading
+from array import array
+from pathlib import Path
+from .utils import walk_tree
+from .parser import UNICODE_CASE_FOLDS
+
+# Name of the index file, it is saved in the root directory of the indexed tree
+INDEX_NAME = '.pseek_index'
+INDEX_VERSION = 3
+# Larger files are not indexed (they are always searched)
+INDEX_MAX_SIZE = 64 * 1_048_576
+# Compact the posting lists when this fraction of their file ids belongs to deleted or changed files
+COMPACT_RATIO = 0.25
+
+
+def file_trigrams(data: bytes) -> set:
+    """Return the trigrams (as 24-bit integers) of each line of the data, ignoring ASCII case"""
+    trigrams = set()
+    # Content search matches line by line, so trigrams that cross a newline are not needed
+    for line in set(data.lower().split(b'\n')):
+        trigrams.update(zip(line, line[1:], line[2:]))
+    return {a << 16 | b << 8 | c for a, b, c in trigrams}
+
+
+class TrigramIndex:
+    """
+    Trigram index of the file contents of a directory tree.
+
+    files maps each path (relative to root) to (file id, mtime_ns, size, inode) and postings maps each trigram
+    to the ids of the files that contain it. Files that are not in the index or have changed since they were
+    indexed are never excluded, so a stale index only makes the search slower, never wrong.
+
+    The index is walked with walk_tree like the searches, and it only excludes files that passed the search
+    filters (should_skip), so indexed and unindexed searches see the same set of files.
+    Ids of deleted or changed files stay in the posting lists (they no longer belong to any path) until
+    the index is compacted.
+
+    The index file only holds plain data: a JSON header line (version, files and count of trigrams) followed
+    by the trigrams, the lengths and the file ids of the posting lists as array('I') bytes.
+    """
+
+    def __init__(self, root: Path, files: dict = None, postings: dict = None, next_id: int = 0):
+        self.root = root
+        self.files = files if files is not None else {}
+        self.postings = postings if postings is not None else {}
+        self.next_id = next_id
+        self.root_prefix = str(root).rstrip(os.sep) + os.sep
+
+    @classmethod
+    def load(cls, root: Path):
+        """
+        Load the index saved in root. Return None if there is no valid index, or if the index file belongs
+        to another user (it decides which files are searched, so it must not come from an untrusted tree).
+        """
+        try:
+            with open(root / INDEX_NAME, 'rb') as f:
+                if hasattr(os, 'getuid') and os.fstat(f.fileno()).st_uid != os.getuid():
+                    return None
+
+                header = json.loads(f.readline())
+                if header.get('version') != INDEX_VERSION:
+                    return None
+
+                trigrams, lengths, ids = array('I'), array('I'), array('I')
+                count = header['trigrams']
+                trigrams.frombytes(f.read(count * trigrams.itemsize))
+                lengths.frombytes(f.read(count * lengths.itemsize))
+                ids.frombytes(f.read())
+                if header['byteorder'] != sys.byteorder:
+                    for blob in (trigrams, lengths, ids):
+                        blob.byteswap()
+                if len(lengths) != count or sum(lengths) != len(ids):
+                    return None
+
+            postings = {}
+            start = 0
+            for trigram, length in zip(trigrams, lengths):
+                postings[trigram] = ids[start:start + length]
+                start += length
+
+            files = {rel_path: tuple(record) for rel_path, record in header['files'].items()}
+            return cls(root, files, postings, header['next_id'])
+        except Exception:
+            return None
+
+    @classmethod
+    def find(cls, path: Path):
+        """Find and load the index of path (saved in path itself or one of its parents, see load)"""
+        path = path.resolve()
+        for root in (path, *path.parents):
+            if (root / INDEX_NAME).is_file():
+                return cls.load(root)
+        return None
+
+    @classmethod
+    def build(cls, root: Path):
+        """Build a new index of every file under root"""
+        index = cls(root.resolve())
+        for entry, p_resolved in walk_tree(root):
+            index.add_file(entry, p_resolved)
+        return index
+
+    def save(self):
+        """Write the index to the root directory"""
+        index_path = self.root / INDEX_NAME
+        tmp_path = index_path.with_name(INDEX_NAME + '.tmp')
+        trigrams = array('I', self.postings)
+        lengths = array('I', (len(ids) for ids in self.postings.values()))
+        header = {'version': INDEX_VERSION, 'byteorder': sys.byteorder, 'next_id': self.next_id,
+                  'files': self.files, 'trigrams': len(trigrams)}
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(trigrams.tobytes())
+            f.write(lengths.tobytes())
+            for ids in self.postings.values():
+                f.write(ids.tobytes())
+        # Replace the old index only when the new one is completely written
+        os.replace(tmp_path, index_path)
+
+    def relative(self, p_resolved: Path):
+        """Return the path relative to root, or None if it is outside of root"""
+        p = str(p_resolved)
+        return p[len(self.root_prefix):] if p.startswith(self.root_prefix) else None
+
+    def file_stat(self, entry: os.DirEntry, p_resolved: Path):
+        """Return (relative path, stat) of a walked entry, or None if it is not a file that can be indexed"""
+        rel_path = self.relative(p_resolved)
+        if rel_path is None or entry.name == INDEX_NAME:
+            return None
+
+        try:
+            if not entry.is_file():
+                return None
+            stat = entry.stat()
+        except OSError:
+            return None
+
+        return (rel_path, stat) if 0 < stat.st_size <= INDEX_MAX_SIZE else None
+
+    def add_trigrams(self, rel_path: str, stat: os.stat_result, trigrams: set):
+        """Add a file and its trigrams to the index"""
+        file_id = self.next_id
+        self.next_id += 1
+        self.files[rel_path] = (file_id, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, array('I')).append(file_id)
+
+    def add_file(self, entry: os.DirEntry, p_resolved: Path) -> bool:
+        """Read and index a file. Returns True if the file was indexed."""
+        file_stat = self.file_stat(entry, p_resolved)
+        if file_stat is None:
+            return False
+
+        try:
+            with open(entry.path, 'rb') as f:
+                trigrams = file_trigrams(f.read())
+        except OSError:
+            return False
+
+        self.add_trigrams(*file_stat, trigrams)
+        return True
+
+    def update(self) -> tuple:
+        """
+        Update the index incrementally. The tree is walked using stat data only, and only new files and
+        files whose (mtime_ns, size, inode) changed are read again. Deleted files are dropped.
+        If too many ids are unused, the posting lists are compacted in a background thread
+        while the changed files are read.
+
+        Returns:
+            (int, int): count of files that were (re)indexed and count of files that were removed
+        """
+        seen = set()
+        changed = []
+        for entry, p_resolved in walk_tree(self.root):
+            file_stat = self.file_stat(entry, p_resolved)
+            if file_stat is None:
+                continue
+
+            rel_path, stat = file_stat
+            seen.add(rel_path)
+            record = self.files.get(rel_path)
+            if record is None or record[1:] != (stat.st_mtime_ns, stat.st_size, stat.st_ino):
+                changed.append((entry, rel_path, stat))
+
+        # Changed files get a new id, so their old one is removed like the ones of deleted files
+        removed = [rel_path for rel_path in self.files if rel_path not in seen]
+        for rel_path in removed + [rel_path for _, rel_path, _ in changed]:
+            self.files.pop(rel_path, None)
+
+        compaction = None
+        if self.next_id - len(self.files) > COMPACT_RATIO * self.next_id:
+            compaction = threading.Thread(target=self.compact, daemon=True)
+            compaction.start()
+
+        new_files = []
+        for entry, rel_path, stat in changed:
+            try:
+                with open(entry.path, 'rb') as f:
+                    new_files.append((rel_path, stat, file_trigrams(f.read())))
+            except OSError:
+                continue
+
+        if compaction is not None:
+            compaction.join()
+        for new_file in new_files:
+            self.add_trigrams(*new_file)
+
+        return len(new_files), len(removed)
+
+    def compact(self):
+        """Remove the ids of deleted and changed files from the posting lists and renumber the files"""
+        id_map = {}
+        for new_id, (rel_path, record) in enumerate(sorted(self.files.items(), key=lambda item: item[1][0])):
+            id_map[record[0]] = new_id
+            self.files[rel_path] = (new_id, *record[1:])
+
+        postings = {}
+        for trigram, ids in self.postings.items():
+            kept = array('I', (id_map[file_id] for file_id in ids if file_id in id_map))
+            if kept:
+                postings[trigram] = kept
+
+        self.postings = postings
+        self.next_id = len(self.files)
+
+    def candidates(self, requirement, encoding: str = 'utf-8'):
+        """
+        Return the ids of the files that may match a literal requirement (see ExprNode.required_literals)
+        in the given encoding, or None if any file may match.
+        """
+        if requirement is None:
+            return None
+
+        op = requirement[0]
+        if op == 'lit':
+            _, text, case_sensitive = requirement
+            # The index ignores only ASCII case
+            if not case_sensitive and not text.isascii():
+                return None
+            if not case_sensitive:
+                # Letters that also match non-ASCII characters (see UNICODE_CASE_FOLDS) split the literal
+                text = ''.join('\n' if char.lower() in UNICODE_CASE_FOLDS else char for char in text)
+
+            try:
+                data = text.encode(encoding)
+            except UnicodeEncodeError:
+                return None
+
+            trigrams = set()
+            for part in data.lower().split(b'\n'):
+                trigrams.update(a << 16 | b << 8 | c for a, b, c in zip(part, part[1:], part[2:]))
+            if not trigrams:
+                return None  # Too short to use the index
+
+            result = None
+            # Start from the rarest trigram to keep the intersection small
+            for trigram in sorted(trigrams, key=lambda t: len(self.postings.get(t, ()))):
+                ids = self.postings.get(trigram, ())
+                result = set(ids) if result is None else result.intersection(ids)
+                if not result:
+                    break
+            return result
+
+        parts = [self.candidates(part, encoding) for part in requirement[1]]
+        if op == 'and':
+            known = [part for part in parts if part is not None]
+            return set.intersection(*known) if known else None
+        if None in parts:
+            return None
+        return set().union(*parts)
+
+    def excludes(self, p_resolved: Path, stat: os.stat_result, candidates: set) -> bool:
+        """Return True if the file is indexed, has not changed since then and is not one of the candidates"""
+        record = self.files.get(self.relative(p_resolved))
+        return record is not None and record[0] not in candidates \
+            and record[1:] == (stat.st_mtime_ns, stat.st_size, stat.st_ino)
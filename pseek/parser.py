@@ -1,7 +1,33 @@
-import re, sys, click
-from lark import Lark, Transformer
+import re, math, click, functools
 from .utils import compile_regex
-from rapidfuzz import fuzz
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+# Regex repeat opcodes (possessive repeats and atomic groups exist since Python 3.11)
+REPEAT_OPS = tuple(
+    getattr(sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, name)
+)
+ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+# The word scores of a fuzzy term are cached, the cache is cleared when it has more words than this
+FUZZY_CACHE_SIZE = 100_000
+# Number of parsed queries kept in memory (see parse_query_expression)
+QUERY_CACHE_SIZE = 128
+# Non-ASCII characters that str patterns match for ASCII letters when case is ignored (binary patterns don't)
+UNICODE_CASE_FOLDS = {'i': '\u0130\u0131', 'k': '\u212a', 's': '\u017f'}
+
+# rapidfuzz modules, imported with the first fuzzy term (see import_rapidfuzz)
+fuzz = process = None
+
+
+def import_rapidfuzz():
+    """Import rapidfuzz, which is slow to import and only needed for fuzzy terms"""
+    global fuzz, process
+    if fuzz is None:
+        from rapidfuzz import fuzz, process
 
 
 class ExprNode:
@@ -9,6 +35,31 @@ class ExprNode:
     def evaluate(self, text: str) -> bool:
         raise NotImplementedError
 
+    def find(self, text: str, found: dict) -> bool:
+        """
+        Evaluate the node like evaluate, and save the match spans of each evaluated term in found
+        (term node -> list of (start, end)), so the text is scanned only once per term.
+        """
+        raise NotImplementedError
+
+    def leaves(self):
+        """Yield the term nodes of the tree"""
+        raise NotImplementedError
+
+    def required_literals(self):
+        """
+        Return the literal strings that a matching text must contain (used to skip files quickly).
+
+        Returns:
+            None if nothing is required, ('lit', text, case_sensitive) for a single literal,
+            or ('and', [...]) / ('or', [...]) to combine them
+        """
+        return None
+
+    def cost(self) -> float:
+        """Estimated cost of evaluating the node on a line (used to order AND/OR children)"""
+        return 1
+
 
 class TermNode(ExprNode):
     """Node representing a single search term"""
@@ -30,6 +81,19 @@ class TermNode(ExprNode):
                     term = r'\b' + term + r'\b'
 
             self.pattern = compile_regex(term, flags)  # Precompile the regex pattern for performance
+        else:
+            import_rapidfuzz()
+            self.fuzzy_term = term if case_sensitive else term.lower()
+            # fuzz.ratio is 100 * (1 - distance / (len(a) + len(b))) and the distance is at least the difference
+            # of the lengths, so words outside of these lengths can't reach fuzzy_level and are never scored
+            max_diff = 1 - fuzzy_level / 100
+            size = len(self.fuzzy_term)
+            min_len = max(math.ceil(size * (1 - max_diff) / (1 + max_diff) - 1e-9), 1)
+            max_len = math.floor(size * (1 + max_diff) / (1 - max_diff) + 1e-9) if max_diff < 1 else ''
+            self.word_pattern = re.compile(rf'(?<!\w)\w{{{min_len},{max_len}}}(?!\w)')
+            # Word -> whether it matches (shared by every line and file of the search)
+            self.word_matches = {}
+        self.regex = regex
 
     def evaluate(self, text: str) -> bool:
         if not self.fuzzy:
@@ -40,8 +104,7 @@ class TermNode(ExprNode):
         term = self.raw_term if self.case_sensitive else self.raw_term.lower()
 
         if self.whole_word:
-            words = re.findall(r'\w+', text_cmp)
-            return any(fuzz.ratio(term, word) >= self.fuzzy_level for word in words)
+            return bool(self.fuzzy_word_spans(text))
         else:
             # Use the correct method depending on the len of str to increase accuracy and avoid illogical matching
             if len(text_cmp) > len(term):
@@ -53,24 +116,134 @@ class TermNode(ExprNode):
 
     def count_matches(self, text: str) -> int:
         """Count how many times the pattern or fuzzy term appears in the text"""
-        if not self.fuzzy:
-            return len(list(self.pattern.finditer(text)))
+        return len(self.spans(text))
 
+    def spans(self, text: str) -> list:
+        """Return the (start, end) of every match in the text (non-overlapping parts for fuzzy substrings)"""
+        if not self.fuzzy:
+            return [match.span() for match in self.pattern.finditer(text)]
+        if not self.whole_word:
+            return self.fuzzy_substring_spans(text)
+
+        return self.fuzzy_word_spans(text)
+
+    def fuzzy_substring_spans(self, text: str) -> list:
+        """
+        Return the (start, end) of the parts of the text that fuzzy match the term.
+        The best alignment of the term in the text is found with fuzz.partial_ratio_alignment (the same score
+        as evaluate), then the text before and after it is searched the same way, so each match costs
+        two more scans in rapidfuzz and the text is never scanned in Python.
+        """
+        text_cmp = text if self.case_sensitive else text.lower()
+        term = self.fuzzy_term
+        # Like evaluate: a text that is not longer than the term is compared as a whole
+        if len(text_cmp) <= len(term):
+            return [(0, len(text_cmp))] if text_cmp and fuzz.ratio(term, text_cmp) >= self.fuzzy_level else []
+
+        spans = []
+        parts = [(0, len(text_cmp))]
+        while parts:
+            start, end = parts.pop()
+            # Parts shorter than the term would be aligned inside the term instead, so they are not searched
+            if end - start < len(term):
+                continue
+
+            alignment = fuzz.partial_ratio_alignment(term, text_cmp[start:end], score_cutoff=self.fuzzy_level)
+            if alignment is None or alignment.dest_end <= alignment.dest_start:
+                continue
+
+            match_start = start + alignment.dest_start
+            match_end = start + alignment.dest_end
+            parts.append((start, match_start))
+            parts.append((match_end, end))
+
+            # The alignment has the length of the term, so it may include spaces around a shorter match
+            while text_cmp[match_start].isspace() and match_end - match_start > 1:
+                match_start += 1
+            while text_cmp[match_end - 1].isspace() and match_end - match_start > 1:
+                match_end -= 1
+            spans.append((match_start, match_end))
+
+        return sorted(spans)
+
+    def fuzzy_word_spans(self, text: str) -> list:
+        """
+        Return the (start, end) of the words of the text that fuzzy match the term.
+        Only words whose length can reach fuzzy_level are found (see word_pattern), and each distinct word
+        is scored only once per search: words of a line that were not seen before are scored together
+        with rapidfuzz, and the results are cached.
+        """
         text_cmp = text if self.case_sensitive else text.lower()
-        term = self.raw_term if self.case_sensitive else self.raw_term.lower()
-
-        if self.whole_word:
-            words = re.findall(r'\w+', text_cmp)
-            return sum(1 for word in words if fuzz.ratio(term, word) >= self.fuzzy_level)
 
-        # Optionally could implement a sliding window here, but it's expensive
-        return 0
+        # Look up each word once, the shared cache may be cleared by another thread at any time
+        matched = {}
+        new_words = []
+        for word in set(self.word_pattern.findall(text_cmp)):
+            is_match = self.word_matches.get(word)
+            if is_match is None:
+                new_words.append(word)
+                is_match = False
+            matched[word] = is_match
+
+        if new_words:
+            for word, _, _ in process.extract(self.fuzzy_term, new_words, scorer=fuzz.ratio,
+                                              score_cutoff=self.fuzzy_level, limit=None):
+                matched[word] = True
+
+            if len(self.word_matches) + len(new_words) > FUZZY_CACHE_SIZE:
+                self.word_matches.clear()
+            self.word_matches.update((word, matched[word]) for word in new_words)
+
+        if not any(matched.values()):
+            return []
+        return [match.span() for match in self.word_pattern.finditer(text_cmp) if matched[match.group()]]
+
+    def find(self, text: str, found: dict) -> bool:
+        found[self] = self.spans(text)
+        return bool(found[self])
+
+    def leaves(self):
+        yield self
+
+    def cost(self) -> float:
+        # literal < whole word < regex < fuzzy (fuzzy terms are scored with rapidfuzz)
+        if self.fuzzy:
+            return 100
+        if self.regex:
+            return 10
+        return 3 if self.whole_word else 1
 
-    def get_binary_pattern(self) -> re.Pattern:
-        """Return a compiled binary regex pattern"""
+    def required_literals(self):
+        if self.fuzzy:
+            return None
+        if self.regex:
+            return regex_literals(self.pattern.pattern, self.pattern.flags)
+        return ('lit', self.raw_term, self.case_sensitive) if self.raw_term else None
+
+    def get_binary_pattern(self, encoding: str = 'utf-8') -> re.Pattern:
+        """
+        Return a compiled binary regex pattern that matches the bytes (in the given encoding) of every match
+        of the term, and may match more: for whole words, a binary \b is only added next to an ASCII word
+        character of the term (binary patterns don't treat non-ASCII characters as word characters, so a \b
+        next to another character could reject a match), so the matching lines must be checked with the term.
+        Regex terms and non-ASCII terms that ignore case are not supported, because binary patterns ignore
+        only ASCII case.
+        """
         if self.fuzzy:
             raise NotImplementedError("Binary pattern is not supported for fuzzy matching.")
-        return re.compile(self.pattern.pattern.encode("utf-8"), self.pattern.flags)
+        if self.regex or not (self.raw_term.isascii() or self.case_sensitive):
+            raise NotImplementedError("Binary pattern is not supported for regex and non-ASCII terms.")
+
+        if self.case_sensitive:
+            pattern = re.escape(self.raw_term.encode(encoding))
+        else:
+            pattern = ignore_case_binary_pattern(self.raw_term, encoding)
+        if self.whole_word:
+            if is_ascii_word(self.raw_term[:1]):
+                pattern = rb'\b' + pattern
+            if is_ascii_word(self.raw_term[-1:]):
+                pattern += rb'\b'
+        return re.compile(pattern, 0 if self.case_sensitive else re.IGNORECASE)
 
 
 class NotNode(ExprNode):
@@ -81,6 +254,15 @@ class NotNode(ExprNode):
     def evaluate(self, text: str) -> bool:
         return not self.child.evaluate(text)
 
+    def find(self, text: str, found: dict) -> bool:
+        return not self.child.find(text, found)
+
+    def leaves(self):
+        yield from self.child.leaves()
+
+    def cost(self) -> float:
+        return self.child.cost()
+
 
 class AndNode(ExprNode):
     """Node representing logical AND"""
@@ -91,6 +273,19 @@ class AndNode(ExprNode):
     def evaluate(self, text: str) -> bool:
         return self.left.evaluate(text) and self.right.evaluate(text)
 
+    def find(self, text: str, found: dict) -> bool:
+        return self.left.find(text, found) and self.right.find(text, found)
+
+    def leaves(self):
+        yield from self.left.leaves()
+        yield from self.right.leaves()
+
+    def required_literals(self):
+        return combine_literals('and', self.left.required_literals(), self.right.required_literals())
+
+    def cost(self) -> float:
+        return self.left.cost() + self.right.cost()
+
 
 class OrNode(ExprNode):
     """Node representing logical OR"""
@@ -101,129 +296,371 @@ class OrNode(ExprNode):
     def evaluate(self, text: str) -> bool:
         return self.left.evaluate(text) or self.right.evaluate(text)
 
+    def find(self, text: str, found: dict) -> bool:
+        return self.left.find(text, found) or self.right.find(text, found)
 
-# Lark grammar for parsing logical expressions
-query_grammar = r"""
-?start: expr
+    def leaves(self):
+        yield from self.left.leaves()
+        yield from self.right.leaves()
 
-?expr: or_expr
+    def required_literals(self):
+        return combine_literals('or', self.left.required_literals(), self.right.required_literals())
 
-?or_expr: and_expr
-        | or_expr "or" and_expr     -> or_expr
+    def cost(self) -> float:
+        return self.left.cost() + self.right.cost()
 
-?and_expr: not_expr
-         | and_expr "and" not_expr  -> and_expr
 
-?not_expr: "not" not_expr           -> not_expr
-         | term
+class MultiTermNode(ExprNode):
+    """
+    Node representing several literal terms joined with OR.
+    They are merged into one alternation pattern, so a text is scanned once instead of once per term.
+    """
+    def __init__(self, terms: list):
+        self.terms = terms
+
+        # Terms with the same options are merged into a prefix tree, e.g. ERR1, ERR2 -> ERR(?:1|2)
+        groups = {}
+        for term in terms:
+            groups.setdefault((term.case_sensitive, term.whole_word), []).append(term.raw_term)
+
+        alternatives = []
+        for (case_sensitive, whole_word), words in groups.items():
+            alternative = f'(?:{literal_trie_pattern(words)})'
+            if whole_word:
+                alternative = r'\b' + alternative + r'\b'
+            alternatives.append(f'(?{"-" if case_sensitive else ""}i:{alternative})')
+        self.pattern = compile_regex('|'.join(alternatives))
 
-?term: PREFIXED_STRING          -> prefixed_string
-     | ESCAPED_STRING           -> string
-     | "(" expr ")"
+    def evaluate(self, text: str) -> bool:
+        return bool(self.pattern.search(text))
 
-PREFIXED_STRING: /(r|c|w|f|rc|cr|cw|wc|cf|fc|wf|fw|cwf|cfw|wcf|wfc|fcw|fwc)"([^"\\]|\\.)*"/
+    def spans(self, text: str) -> list:
+        """Return the (start, end) of every match in the text"""
+        return [match.span() for match in self.pattern.finditer(text)]
 
-%import common.ESCAPED_STRING
-%import common.WS
-%ignore WS
-"""
+    def find(self, text: str, found: dict) -> bool:
+        spans = found[self] = self.spans(text)
+        return bool(spans)
 
+    def leaves(self):
+        yield self
 
-class TreeToExpr(Transformer):
-    """Transform parsed tree into expression tree (ExprNode subclasses)"""
-    def __init__(self, fuzzy_level):
-        super().__init__()
-        self.fuzzy_level = fuzzy_level
+    def required_literals(self):
+        return combine_literals('or', *(term.required_literals() for term in self.terms))
+
+    def cost(self) -> float:
+        return 2  # One scan of the text, whatever the number of terms
 
-    def string(self, s):
-        """ Match normal quoted string: "foo" """
-        term = s[0][1:-1]  # Remove surrounding quotes (e.g., "foo" -> foo)
-        return TermNode(
-            term,
-            False,
-            False,
-            False,
-            False,
-            None
-        )
-
-    def prefixed_string(self, s):
-        text = str(s[0])  # e.g., 'rc"pattern"'
-        prefix = text.split('"', 1)[0].lower()
-        content = text.split('"', 1)[1][:-1]
-
-        return TermNode(
-            content,
-            regex='r' in prefix,
-            whole_word='w' in prefix,
-            case_sensitive='c' in prefix,
-            fuzzy='f' in prefix,
-            fuzzy_level=self.fuzzy_level
-        )
-
-    def and_expr(self, args):
-        return AndNode(args[0], args[1])
-
-    def or_expr(self, args):
-        return OrNode(args[0], args[1])
-
-    def not_expr(self, args):
-        return NotNode(args[0])
 
+def combine_literals(op: str, *requirements):
+    """
+    Combine literal requirements with 'and' / 'or'.
+    For 'and', unknown (None) parts are dropped. For 'or', one unknown part makes the whole result unknown.
+    """
+    if op == 'or' and None in requirements:
+        return None
 
+    parts = []
+    for requirement in requirements:
+        if requirement is None:
+            continue
+        # Flatten nested requirements of the same type
+        parts.extend(requirement[1] if requirement[0] == op else [requirement])
+
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else (op, parts)
+
+
+def compile_prefilter(requirement, encoding: str = 'utf-8'):
+    """
+    Compile a literal requirement (see ExprNode.required_literals) into a function that checks
+    whether a bytes buffer (bytes or mmap) in the given encoding may match, without decoding it.
+    Returns None if nothing can be checked.
+    """
+    if requirement is None:
+        return None
+
+    op = requirement[0]
+    if op == 'lit':
+        pattern = literal_binary_pattern(requirement, encoding)
+        if pattern is None:
+            return None
+        if isinstance(pattern, bytes):
+            return lambda buf: buf.find(pattern) != -1
+        return lambda buf: pattern.search(buf) is not None
+
+    if op == 'or':
+        # Merge the literals into one pattern, so the buffer is scanned only once
+        alternatives = [
+            literal_binary_pattern(part, encoding) if part[0] == 'lit' else None for part in requirement[1]
+        ]
+        if None not in alternatives:
+            pattern = re.compile(b'|'.join(
+                re.escape(alt) if isinstance(alt, bytes) else b'(?i:' + alt.pattern + b')' for alt in alternatives
+            ))
+            return lambda buf: pattern.search(buf) is not None
+
+    checks = [compile_prefilter(part, encoding) for part in requirement[1]]
+    if op == 'and':
+        checks = [check for check in checks if check is not None]
+        if not checks:
+            return None
+        return lambda buf: all(check(buf) for check in checks)
+
+    if None in checks:
+        return None
+    return lambda buf: any(check(buf) for check in checks)
+
+
+def compile_anchor(requirement, encoding: str = 'utf-8'):
+    """
+    Compile a literal requirement (see ExprNode.required_literals) into one binary pattern that matches
+    somewhere in every line the expression can match (used to find candidate lines in a whole buffer).
+    Returns None if some matching lines may not contain any required literal.
+    """
+    literals = anchor_literals(requirement, encoding)
+    if not literals:
+        return None
+
+    alternatives = [literal_binary_pattern(literal, encoding) for literal in literals]
+    return re.compile(b'|'.join(
+        re.escape(alt) if isinstance(alt, bytes) else b'(?i:' + alt.pattern + b')' for alt in alternatives
+    ))
+
+
+def anchor_literals(requirement, encoding: str = 'utf-8'):
+    """Return literal requirements such that each matching line contains at least one of them, or None"""
+    if requirement is None:
+        return None
+
+    op = requirement[0]
+    if op == 'lit':
+        return [requirement] if literal_binary_pattern(requirement, encoding) is not None else None
+
+    options = [anchor_literals(part, encoding) for part in requirement[1]]
+    if op == 'or':
+        # Every branch must give its own literals
+        return None if None in options else [literal for option in options for literal in option]
+
+    # For 'and' one part is enough: prefer fewer and longer literals (fewer false candidates)
+    options = [option for option in options if option]
+    if not options:
+        return None
+    return min(options, key=lambda option: (len(option), -min(len(literal[1]) for literal in option)))
+
+
+def literal_binary_pattern(requirement, encoding: str = 'utf-8'):
+    """
+    Return the bytes (in the given encoding) of a case-sensitive literal requirement or a binary pattern
+    for a case-insensitive one. Returns None for case-insensitive non-ASCII literals (binary patterns
+    ignore only ASCII case) and for literals that can't be encoded.
+    """
+    _, text, case_sensitive = requirement
+    if not case_sensitive and not text.isascii():
+        return None
+    try:
+        if case_sensitive:
+            return text.encode(encoding)
+        return re.compile(ignore_case_binary_pattern(text, encoding), re.IGNORECASE)
+    except UnicodeEncodeError:
+        return None
+
+
+def is_ascii_word(char: str) -> bool:
+    """Return True if char is a word character for binary patterns (an ASCII letter, digit or underscore)"""
+    return char.isascii() and (char.isalnum() or char == '_')
+
+
+def ignore_case_binary_pattern(text: str, encoding: str = 'utf-8') -> bytes:
+    """
+    Return the source of a binary pattern that matches an ASCII text in the given encoding when it is compiled
+    with re.IGNORECASE. The letters of UNICODE_CASE_FOLDS also match their non-ASCII forms (e.g. the Kelvin
+    sign for k), like a case-insensitive str pattern.
+    """
+    pattern = b''
+    for char in text:
+        alternatives = [re.escape(char.encode(encoding))]
+        for fold in UNICODE_CASE_FOLDS.get(char.lower(), ''):
+            try:
+                alternatives.append(re.escape(fold.encode(encoding)))
+            except UnicodeEncodeError:
+                continue  # The decoded text can't contain it
+        pattern += alternatives[0] if len(alternatives) == 1 else b'(?:' + b'|'.join(alternatives) + b')'
+    return pattern
+
+
+def regex_literals(pattern: str, flags: int = 0):
+    """Return the literal strings that any match of a regex must contain (see ExprNode.required_literals)"""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+
+    case_sensitive = not (parsed.state.flags & re.IGNORECASE)
+
+    def walk(items, case_sensitive):
+        requirements = []
+        run = []  # current sequence of adjacent literal characters
+
+        def end_run():
+            if run:
+                requirements.append(('lit', ''.join(run), case_sensitive))
+                run.clear()
+
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                run.append(chr(av))
+            elif op == sre_parse.AT:
+                continue  # Anchors don't consume characters, so the literal run can continue
+            else:
+                end_run()
+                if op == sre_parse.SUBPATTERN:
+                    # Groups that change flags are treated as case-insensitive (it only makes them less selective)
+                    add_flags, del_flags = av[1], av[2]
+                    requirements.append(walk(av[3], case_sensitive and not (add_flags or del_flags)))
+                elif op in REPEAT_OPS:
+                    # The repeated item is required only if it must appear at least once
+                    if av[0] >= 1:
+                        requirements.append(walk(av[2], case_sensitive))
+                elif op == sre_parse.BRANCH:
+                    requirements.append(combine_literals('or', *(walk(branch, case_sensitive) for branch in av[1])))
+                elif op == ATOMIC_GROUP:
+                    requirements.append(walk(av, case_sensitive))
+        end_run()
+
+        return combine_literals('and', *requirements)
+
+    return walk(parsed, case_sensitive)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
 def parse_query_expression(query: str, expr, regex, whole_word, case_sensitive, fuzzy, fuzzy_level) -> ExprNode:
     """
     Function to parse the query and return expression tree.
     If expr is False, treat the whole query as a single term.
+    Trees are cached by their arguments, so a repeated query (in the API or the search server) is parsed once.
+    The returned tree is shared and must not be changed. Raises ValueError if the query can't be parsed.
     """
 
     if not expr:
         return TermNode(query, regex, whole_word, case_sensitive, fuzzy, fuzzy_level)
 
-    # Otherwise, parse using Lark
-    parser = Lark(query_grammar, parser="lalr")
+    # Otherwise, parse using Lark (imported only for expressions)
+    from .grammar import get_query_parser, TreeToExpr
+
     try:
-        tree = parser.parse(query)
-        return TreeToExpr(fuzzy_level).transform(tree)
+        tree = get_query_parser().parse(query)
+        return optimize_expression(TreeToExpr(fuzzy_level).transform(tree))
     except Exception as e:
-        click.echo(click.style("Query parser error:\n\n", fg='red') + str(e))
-        sys.exit(1)
+        raise ValueError(f"Query parser error:\n\n{e}") from None
 
 
-def highlight_text(expr: ExprNode, text: str, fuzzy: bool) -> str:
+def optimize_expression(node: ExprNode) -> ExprNode:
     """
-    Highlight matching parts of the text.
-    Only highlights fuzzy matches when whole_word=True.
+    Optimize the expression tree before searching:
+    - Merge the literal (non-regex and non-fuzzy) terms of each OR chain into one MultiTermNode.
+    - Flatten AND/OR chains and order their children by estimated cost (see ExprNode.cost),
+      so cheap terms can short-circuit the evaluation of expensive ones.
     """
-    matches = []
+    if isinstance(node, NotNode):
+        return NotNode(optimize_expression(node.child))
+    if not isinstance(node, (AndNode, OrNode)):
+        return node
+
+    node_type = type(node)
+    # Collect the children of the whole chain, e.g. "a" or ("b" or r"c")
+    children = []
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, node_type):
+            stack.extend((current.right, current.left))
+        else:
+            children.append(optimize_expression(current))
 
-    def collect_matches(node):
-        if isinstance(node, TermNode):
-            # Skip fuzzy highlight if whole_word is False
-            if node.fuzzy:
-                if not node.whole_word:
-                    return  # skip highlighting
-                text_cmp = text if node.case_sensitive else text.lower()
-                term = node.raw_term if node.case_sensitive else node.raw_term.lower()
+    if node_type is OrNode:
+        literals = [child for child in children if isinstance(child, TermNode) and not child.fuzzy and not child.regex]
+        if len(literals) >= 2:
+            # Put the merged node in place of the first literal term
+            first = children.index(literals[0])
+            children = [child for child in children if child not in literals]
+            children.insert(first, MultiTermNode(literals))
 
-                # collect word matches
-                for match in re.finditer(r'\w+', text_cmp):
-                    word = match.group()
-                    if fuzz.ratio(term, word) >= node.fuzzy_level:
-                        matches.append((match.start(), match.end()))
-            else:
-                for match in node.pattern.finditer(text):
-                    matches.append((match.start(), match.end()))
-        elif isinstance(node, AndNode) or isinstance(node, OrNode):
-            collect_matches(node.left)
-            collect_matches(node.right)
-        elif isinstance(node, NotNode):
-            collect_matches(node.child)
+    # Sorting is stable, so children with the same cost keep the written order
+    children.sort(key=lambda child: child.cost())
+    return build_chain(node_type, children)
+
+
+def literal_trie_pattern(words: list) -> str:
+    """
+    Build a regex that matches any of the words, with their common prefixes merged (like a trie).
+    This is much faster than a plain alternation because each position of the text is checked only once per
+    prefix. Optional parts are greedy, so the longest word is matched when several words start at the same position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # End of a word
+
+    def build(node) -> str:
+        branches = []
+        for char, child in sorted(node.items()):
+            if not char:
+                continue
+            part = re.escape(char)
+            # Join the chains of single characters to keep the pattern (and the recursion) small
+            while len(child) == 1 and '' not in child:
+                (char, child), = child.items()
+                part += re.escape(char)
+            branches.append(part + build(child))
+
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # A word ends here, so the rest is optional
+            return ('(?:' + pattern + ')?') if len(branches) == 1 else pattern + '?'
+        return pattern
+
+    return build(trie)
+
+
+def build_chain(node_type, children: list) -> ExprNode:
+    """Join the children with a binary node type (AndNode / OrNode) from left to right"""
+    result = children[0]
+    for child in children[1:]:
+        result = node_type(result, child)
+    return result
+
+
+def match_text(expr: ExprNode, text: str) -> tuple:
+    """
+    Evaluate the expression on the text, scanning it once per term.
+
+    Returns:
+        (bool, int, list): whether it matches, the count of matches (only for a single term expression)
+        and the spans of all terms to highlight
+    """
+    found = {}
+    if not expr.find(text, found):
+        return False, 0, []
+
+    # Terms that were not evaluated because of short-circuiting are still highlighted
+    for term in expr.leaves():
+        if term not in found:
+            found[term] = term.spans(text)
+
+    count = len(found[expr]) if isinstance(expr, TermNode) else 0
+    return True, count, [span for spans in found.values() for span in spans]
 
-    collect_matches(expr)
 
+def highlight_spans(text: str, matches: list) -> str:
+    """Highlight the given (start, end) spans of the text"""
     # Sort and merge overlapping matches (for example, if one match was inside another match)
-    matches.sort()  # sort by start position
+    matches = sorted(matches)  # sort by start position
     merged = []
     for start, end in matches:
         if not merged or start >= merged[-1][1]:  # no overlap
@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+@dataclass
+class NameMatch:
+    """
+    A file or directory whose name matches the query.
+
+    Attributes:
+        search_type (str): 'file' or 'directory'
+        path (Path): the file or directory, or the archive file that contains the matching name
+        member_path (tuple): names from the archive down to the matching member, e.g. ('b.7z', 'dir/c.txt')
+            for a.zip::b.7z::dir/c.txt (empty if the name is not inside an archive)
+        name (str): the matching name (without its parent directories)
+        spans (list): (start, end) of the matching parts of the name
+    """
+    search_type: str
+    path: Path
+    member_path: tuple
+    name: str
+    spans: list
+
+    @property
+    def label(self) -> str:
+        """Virtual path of the match, e.g. a.zip::b.7z::dir/c.txt"""
+        return '::'.join((str(self.path), *self.member_path))
+
+
+@dataclass
+class LineMatch:
+    """
+    A matching line of a file.
+
+    Attributes:
+        line_num (int): line number (starting from 1)
+        offset (int): byte offset of the line in the file or archive member (for the pieces of very long
+            lines, see scanner.MAX_LINE_SIZE, the offset of the piece)
+        text (str): the decoded line without leading and trailing whitespace
+        spans (list): (start, end) of the matching parts of text
+        count (int): count of matches of the query (only for a single term query, 0 otherwise)
+    """
+    line_num: int
+    offset: int
+    text: str
+    spans: list
+    count: int
+
+
+@dataclass
+class ContentMatch:
+    """
+    A file (or archive member) whose content matches the query.
+
+    Attributes:
+        path (Path): the file, or the archive file that contains the member
+        member_path (tuple): names from the archive down to the member (see NameMatch)
+        lines (list): LineMatch of each matching line (empty if no_content is enabled)
+    """
+    path: Path
+    member_path: tuple
+    lines: list
+    search_type: str = field(default='content', init=False)
+
+    @property
+    def label(self) -> str:
+        """Virtual path of the match, e.g. a.zip::b.7z::dir/c.txt"""
+        return '::'.join((str(self.path), *self.member_path))
+
+
+@dataclass
+class Coverage:
+    """
+    How much of the tree a search covered (it may have been stopped by its timeout, see utils.CancelToken).
+
+    Attributes:
+        paths (int): files and directories walked
+        files (int): files sent to content search (the parts of a split zip file count separately)
+        searched (int): files that were searched to the end
+        complete (bool): whether the whole tree was walked and every file was searched
+    """
+    paths: int = 0
+    files: int = 0
+    searched: int = 0
+    complete: bool = False
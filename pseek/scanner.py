@@ -0,0 +1,141 @@
+from .utils import count_newlines
+
+# Size of the blocks read from streams
+CHUNK_SIZE = 1_048_576
+# Lines longer than this are cut into pieces, so a single huge line can't use unbounded memory
+MAX_LINE_SIZE = 1_048_576
+# Bytes of a cut line that are repeated at the start of its next piece, so matches across the cut are found
+LINE_OVERLAP = 4096
+# Files with a NUL byte in their first block are treated as binary and are not searched
+BINARY_SNIFF_SIZE = 8192
+
+
+def is_binary(buf) -> bool:
+    """Check for a NUL byte in the first block of a buffer (bytes or mmap)"""
+    return buf.find(b'\0', 0, BINARY_SNIFF_SIZE) != -1
+
+
+def scan_lines(buf):
+    """
+    Read every line of a buffer (mmap) in chunks from its start like a stream (see scan_stream), so a very long
+    line is cut into pieces of MAX_LINE_SIZE instead of being copied whole.
+
+    Yields:
+        (int, int, bytes): line number, offset and content of the line (without the newline)
+    """
+    buf.seek(0)
+    return scan_stream(buf)
+
+
+def scan_anchor_lines(buf, anchor, start: int = 0, line_num: int = 1, base: int = 0):
+    """
+    Find the lines of a buffer (bytes or mmap) that contain a match of the anchor pattern.
+    The anchor runs over the whole buffer, and line bounds and numbers are recovered only around
+    each hit (by counting the newlines between hits), so lines without a hit cost nothing in Python.
+
+    Parameters:
+        buf (bytes | mmap): buffer to scan
+        anchor (re.Pattern): binary pattern (see parser.compile_anchor)
+        start (int): offset of the beginning of a line to start from
+        line_num (int): number of the line that starts at the start offset
+        base (int): offset of the buffer in its file or stream (added to the returned offsets)
+
+    Yields:
+        (int, int, bytes): line number, offset and content of the line (without the newline)
+    """
+    pos = start
+    size = len(buf)
+    while pos < size:
+        match = anchor.search(buf, pos)
+        if match is None:
+            return
+
+        line_start = buf.rfind(b'\n', pos, match.start()) + 1 or pos
+        line_end = buf.find(b'\n', match.start())
+        if line_end == -1:
+            line_end = size
+
+        line_num += count_newlines(buf, pos, line_start)
+        if line_end - line_start <= MAX_LINE_SIZE:
+            yield line_num, base + line_start, buf[line_start:line_end]
+        else:
+            # Return a very long line in overlapping pieces like iter_chunks, but only the pieces with a hit
+            piece_start = line_start
+            while True:
+                piece_end = min(piece_start + MAX_LINE_SIZE, line_end)
+                if anchor.search(buf, piece_start, piece_end):
+                    yield line_num, base + piece_start, buf[piece_start:piece_end]
+                if piece_end == line_end:
+                    break
+                piece_start = piece_end - LINE_OVERLAP
+
+        # Continue after the end of this line
+        pos = line_end + 1
+        line_num += 1
+
+
+def iter_chunks(stream, chunk_size: int = CHUNK_SIZE, head: bytes = b''):
+    """
+    Read a binary stream (file, pipe, decompression stream, archive member...) in chunks of whole lines.
+    The incomplete last line of each block is carried over to the next chunk, so memory stays around
+    chunk_size + MAX_LINE_SIZE for a stream of any size. head is data already read from the stream.
+
+    Yields:
+        (int, bytes): offset of the chunk in the stream and the chunk, which ends with a newline
+        (except the last one and the pieces of a cut line)
+    """
+    rest = head
+    # Offset of rest in the stream
+    offset = 0
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            if rest:
+                yield offset, rest
+            return
+
+        data = rest + block if rest else block
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            yield offset, data[:cut]
+            rest = data[cut:]
+            offset += cut
+        else:
+            rest = data
+
+        # Cut a very long line and keep an overlap with the next piece (a match inside it may be found twice)
+        while len(rest) > MAX_LINE_SIZE:
+            yield offset, rest[:MAX_LINE_SIZE]
+            rest = rest[MAX_LINE_SIZE - LINE_OVERLAP:]
+            offset += MAX_LINE_SIZE - LINE_OVERLAP
+
+
+def scan_stream(stream, anchor=None, chunk_size: int = CHUNK_SIZE, skip_binary: bool = False):
+    """
+    Read the lines of a binary stream in chunks (see iter_chunks). If an anchor pattern is given,
+    only the lines that contain a match of it are returned (see scan_anchor_lines).
+    If skip_binary is set, nothing is returned for binary streams (see is_binary).
+
+    Yields:
+        (int, int, bytes): line number, offset and content of the line (without the newline)
+    """
+    head = b''
+    if skip_binary:
+        head = stream.read(BINARY_SNIFF_SIZE)
+        if is_binary(head):
+            return
+
+    line_num = 1
+    for offset, chunk in iter_chunks(stream, chunk_size, head):
+        if anchor is not None:
+            yield from scan_anchor_lines(chunk, anchor, 0, line_num, offset)
+        else:
+            lines = chunk.split(b'\n')
+            # The chunk ends with a newline, so the last item is not a line
+            if chunk.endswith(b'\n'):
+                lines.pop()
+            for num, line in enumerate(lines, line_num):
+                yield num, offset, line
+                offset += len(line) + 1
+
+        line_num += chunk.count(b'\n')
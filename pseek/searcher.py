@@ -1,31 +1,33 @@
-import mmap, click, io
+import os, mmap, queue
 from pathlib import Path
-from .utils import compile_regex, get_archive_path_size, try_decode, get_path_suffix
-from .parser import parse_query_expression, TermNode, highlight_text
-from concurrent.futures import ThreadPoolExecutor
-# Archive modules
-import zipfile, py7zr, tarfile, gzip, bz2, lzma, rarfile
+from .utils import (compile_regex, get_archive_path_size, get_path_suffix, walk_tree, spool_stream,
+                    get_archive_member, CancelToken, validate_encoding)
+from .index import INDEX_NAME, TrigramIndex
+from .results import NameMatch, LineMatch, ContentMatch, Coverage
+from .parser import parse_query_expression, TermNode, match_text, compile_prefilter, compile_anchor
+from .scanner import scan_lines, scan_anchor_lines, scan_stream, is_binary
+# Archive modules (and the archive helpers in archives.py) are slow to import, so they are imported
+# only when an archive is opened
 
 # Archive extensions that are allowed
 ARCHIVE_EXTS = ('zip', 'rar', '7z', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'gz', 'bz2', 'xz')
 
-# Extensions that are not suitable for content search (binary, media, etc.)
-EXCLUDED_EXTENSIONS = (
-    'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp', 'svg',
-    'mp4', 'mov', 'avi', 'mkv', 'webm', 'flv', 'm4v', 'mpg', 'wmv',
-    'mp3', 'wav', 'ogg', 'flac', 'aac', 'wma', 'opus',
-    'exe', 'dll', 'bin', 'iso', 'img', 'dat', 'dmg', 'class', 'so', 'o', 'obj',
-    'ttf', 'otf', 'woff', 'woff2', 'eot',
-    'db', 'sqlite', 'mdf', 'bak', 'log', 'jsonl', 'dat',
-    'apk', 'ipa', 'deb', 'rpm', 'pkg', 'appimage', 'jar', 'war',
-    'pyc', 'ps1', 'pem', 'pyd', 'whl'
-)
+# Number of files sent to a worker process at once (to reduce inter-process overhead)
+PROCESS_BATCH_SIZE = 64
+# Zip files larger than this (in MB) are split into work units of their members (see split_archive)
+ARCHIVE_SPLIT_SIZE = 32
+# Uncompressed size of the members of each work unit
+ARCHIVE_UNIT_SIZE = 16 * 1_048_576
+
+# Search instance and compiled patterns of the current worker process (see init_worker)
+_worker = None
 
 
 class Search:
     def __init__(self, base_path, query, case_sensitive, ext, exclude_ext, regex, include, exclude, re_include,
                  re_exclude, whole_word, expr, fuzzy, fuzzy_level, max_size, min_size, archive, depth, arc_ext, arc_ee,
-                 arc_inc, arc_exc, arc_max, arc_min, full_path, no_content):
+                 arc_inc, arc_exc, arc_max, arc_min, full_path, no_content, jobs=None, arc_cache=False,
+                 encoding='utf-8', errors='replace', timeout=None):
         """Initialize search parameters"""
         self.base_path = Path(base_path)
         self.query = query
@@ -53,34 +55,43 @@ class Search:
         self.arc_min = arc_min
         self.full_path = full_path
         self.no_content = no_content
+        # Number of worker processes for content search (None: use threads, 0: CPU count)
+        self.jobs = jobs
+        # On-disk cache of the archive members read by content search
+        self.arc_cache = None
+        if arc_cache:
+            from .cache import ArchiveCache
+            self.arc_cache = ArchiveCache()
+        # Encoding of the searched files and error handler for bytes that can't be decoded
+        validate_encoding(encoding)
+        self.encoding = encoding
+        self.errors = errors
+        # Seconds after which the search is stopped (see CancelToken), and how much of the tree it covered
+        self.timeout = timeout
+        self.cancel = CancelToken()
+        self.coverage = None
         self.result = None
 
-    def should_skip(self, p_resolved: Path, search_type: str) -> bool:
+    def should_skip(self, p_resolved: Path, search_type: str, is_file: bool, is_dir: bool, p_size: float) -> bool:
         """
         Check whether the file/directory should be skipped based on various filters.
+        Type and size information comes from the directory walker, so no extra stat calls are made here.
         Returns True if the path should be skipped.
         """
-        try:
-            p_size_mb = p_resolved.stat().st_size / 1_048_576  # Convert size to MB
-        except OSError:
-            # If path is inaccessible, skip it.
-            return True
-
-        file_ext = get_path_suffix(p_resolved)
+        file_ext = get_path_suffix(p_resolved, is_dir)
 
         # Ignore some filters for archive files when archive is enabled
         if (not self.archive or file_ext not in ARCHIVE_EXTS[:-3]) and \
-                ((search_type in ('file', 'content') and not p_resolved.is_file())
-                 or (search_type == 'directory' and not p_resolved.is_dir())):
+                ((search_type in ('file', 'content') and not is_file)
+                 or (search_type == 'directory' and not is_dir)):
             return True
 
         if (self.include and not any(p_resolved.is_relative_to(inc) for inc in self.include)) \
                 or (self.exclude and any(p_resolved.is_relative_to(exc) for exc in self.exclude)) \
                 or (self.ext and file_ext not in self.ext) \
                 or (self.exclude_ext and file_ext in self.exclude_ext) \
-                or (search_type == 'content' and file_ext in EXCLUDED_EXTENSIONS) \
-                or (self.max_size and p_size_mb > self.max_size) \
-                or (self.min_size and p_size_mb < self.min_size):
+                or (self.max_size and p_size > self.max_size) \
+                or (self.min_size and p_size < self.min_size):
             return True
 
         # Filter by regex include and exclude
@@ -94,7 +105,7 @@ class Search:
     def archive_should_skip(self, path_info: Path, search_type: str, is_file: bool, is_dir: bool, p_size: float):
         """Check whether the file/directory inside archive files should be skipped based on various filters"""
 
-        file_ext = get_path_suffix(path_info)
+        file_ext = get_path_suffix(path_info, is_dir)
 
         if (search_type in ('file', 'content') and not is_file) \
                 or (search_type == 'directory' and not is_dir):
@@ -104,7 +115,6 @@ class Search:
                 or (self.arc_exc and any(path_info.is_relative_to(exc) for exc in self.arc_exc)) \
                 or (self.arc_ext and file_ext not in self.arc_ext) \
                 or (self.arc_ee and file_ext in self.arc_ee) \
-                or (search_type == 'content' and file_ext in EXCLUDED_EXTENSIONS) \
                 or (self.arc_max and p_size > self.arc_max) \
                 or (self.arc_min and p_size < self.arc_min):
             return True
@@ -117,7 +127,7 @@ class Search:
         return False
 
     def extract_names_from_archive(self, file_path: Path, search_type: str,
-                                   file_bytes: bytes = None, parent_label: str = '',
+                                   file_stream=None, parent_path: tuple = (),
                                    depth: int = None):
         """
         Recursively extract files and directories name from archive files.
@@ -126,28 +136,35 @@ class Search:
         Parameters:
             file_path (Path): the archive file path
             search_type (str): search type ( file / directory )
-            file_bytes (bytes | None): optional byte data if already read (for recursion)
-            parent_label (str): string for nested archive tracking like a.zip::b.7z::file.txt
+            file_stream (file object | None): optional binary stream of the archive (for recursion), it is closed
+                when the archive is done
+            parent_path (tuple): names of the nested archives from the outer archive down to this one,
+                like ('b.7z',) for a.zip::b.7z::file.txt
             depth (int): the depth value that is returned recursively
 
         Yields:
-            (str, Path): tuple of parent label and file or directory name
+            (tuple, Path): tuple of the parent path (names of the nested archives) and file or directory name
         """
 
-        file_ext = get_path_suffix(file_path)
-        label_prefix = (parent_label + str(file_path) + '::') if parent_label else '::'
+        import zipfile, py7zr, rarfile
+        from .archives import read_7z_members, open_tar, iter_tar_members
+
+        file_ext = get_path_suffix(file_path, False)
         if depth is None:
             depth = self.depth
 
         try:
-            # Decide the stream source: from disk or memory
-            file_stream = io.BytesIO(file_bytes) if file_bytes is not None else open(file_path, 'rb')
+            # Decide the stream source: from disk or from the parent archive
+            if file_stream is None:
+                file_stream = open(file_path, 'rb')
 
             # Handle ZIP and RAR archives
             if file_ext in ('zip', 'rar'):
                 opener = {'zip': zipfile.ZipFile, 'rar': rarfile.RarFile}[file_ext]
                 with opener(file_stream) as f:
                     for info in f.infolist():
+                        if self.cancel.is_cancelled():
+                            return
                         name = Path(info.filename)
                         if not self.archive_should_skip(
                                 name,
@@ -156,23 +173,30 @@ class Search:
                                 info.is_dir(),
                                 get_archive_path_size(info, file_ext)
                         ):
-                            yield label_prefix, name
+                            yield parent_path, name
 
                         # At each recursion, subtract 1 from depth if it's set
                         new_depth = None if depth is None else depth - 1
                         # Check if this is a nested archive
-                        if get_path_suffix(name) in ARCHIVE_EXTS[:-3] and (new_depth is None or new_depth >= 0):
+                        if get_path_suffix(name, info.is_dir()) in ARCHIVE_EXTS[:-3] \
+                                and (new_depth is None or new_depth >= 0):
+                            with f.open(info) as member:
+                                nested = spool_stream(member)
+
                             yield from self.extract_names_from_archive(
                                 name,
                                 search_type,
-                                f.read(info),
-                                label_prefix,
+                                nested,
+                                parent_path + (str(name),),
                                 new_depth
                             )
             # Handle 7Z archives
             elif file_ext == '7z':
                 with py7zr.SevenZipFile(file_stream, mode='r') as z:
+                    nested_names = []
                     for info in z.list():
+                        if self.cancel.is_cancelled():
+                            return
                         name = Path(info.filename)
                         if not self.archive_should_skip(
                                 name,
@@ -181,33 +205,29 @@ class Search:
                                 info.is_directory,
                                 get_archive_path_size(info, '7z')
                         ):
-                            yield label_prefix, name
+                            yield parent_path, name
 
                         new_depth = None if depth is None else depth - 1
-                        if get_path_suffix(name) in ARCHIVE_EXTS[:-3] and (new_depth is None or new_depth >= 0):
-                            file_data = z.read([info.filename]).get(info.filename)
-                            if file_data is None:
-                                continue
-
-                            yield from self.extract_names_from_archive(
-                                name,
-                                search_type,
-                                file_data.read(),
-                                label_prefix,
-                                new_depth
-                            )
+                        if get_path_suffix(name, info.is_directory) in ARCHIVE_EXTS[:-3] \
+                                and (new_depth is None or new_depth >= 0):
+                            nested_names.append(info.filename)
+
+                    # Read all nested archives with one pass over the archive
+                    for filename, nested in read_7z_members(z, nested_names).items():
+                        yield from self.extract_names_from_archive(
+                            Path(filename),
+                            search_type,
+                            nested,
+                            parent_path + (filename,),
+                            new_depth
+                        )
             # Handle TAR and compressed TAR formats
             elif file_ext in ('tar', 'tar.gz', 'tar.bz2', 'tar.xz'):
-                # Specify the mode based on the file ext to open it
-                mode = {
-                    'tar': 'r',
-                    'tar.gz': 'r:gz',
-                    'tar.bz2': 'r:bz2',
-                    'tar.xz': 'r:xz'
-                }[file_ext]
-
-                with tarfile.open(fileobj=file_stream, mode=mode) as tf:
-                    for member in tf.getmembers():
+                # Read the archive with one sequential pass, each member is handled as it passes
+                with open_tar(file_stream) as tf:
+                    for member in iter_tar_members(tf):
+                        if self.cancel.is_cancelled():
+                            return
                         name = Path(member.name)
                         if not self.archive_should_skip(
                                 name,
@@ -216,10 +236,11 @@ class Search:
                                 member.isdir(),
                                 get_archive_path_size(member, file_ext)
                         ):
-                            yield label_prefix, name
+                            yield parent_path, name
 
                         new_depth = None if depth is None else depth - 1
-                        if get_path_suffix(name) in ARCHIVE_EXTS[:-3] and (new_depth is None or new_depth >= 0):
+                        if get_path_suffix(name, member.isdir()) in ARCHIVE_EXTS[:-3] \
+                                and (new_depth is None or new_depth >= 0):
                             f = tf.extractfile(member)
                             if f is None:
                                 continue
@@ -227,313 +248,561 @@ class Search:
                             yield from self.extract_names_from_archive(
                                 name,
                                 search_type,
-                                f.read(),
-                                label_prefix,
+                                spool_stream(f),
+                                parent_path + (str(name),),
                                 new_depth
                             )
         except Exception:
             return  # silently skip invalid archives
+        finally:
+            if file_stream is not None:
+                file_stream.close()
+
+    def plan_archive_members(self, infos, file_ext: str, new_depth: int):
+        """
+        Choose the archive members to read for content search from their headers alone,
+        so members that are skipped by the filters are never decompressed.
 
-    def extract_text_from_archive(self, file_path: Path, file_bytes: bytes = None,
-                                  parent_label: str = '', depth: int = None):
+        Parameters:
+            infos (iterable): member headers (infolist or list of the archive, or the tar members)
+            file_ext (str): archive type
+            new_depth (int): depth left for the nested archives of this archive
+
+        Yields:
+            (header, Path, bool): member header, name and whether it is a nested archive to search recursively
         """
-        Recursively extract (path_label, text_content) from any archive file.
+        for info in infos:
+            file_name, is_file, is_dir = get_archive_member(info, file_ext)
+
+            # Check if this is a nested archive
+            if get_path_suffix(file_name, is_dir) in ARCHIVE_EXTS and (new_depth is None or new_depth >= 0):
+                yield info, file_name, True
+            elif not self.archive_should_skip(
+                    file_name,
+                    'content',
+                    is_file,
+                    is_dir,
+                    get_archive_path_size(info, file_ext)
+            ):
+                yield info, file_name, False
+
+    def extract_text_from_archive(self, file_path: Path, file_stream=None,
+                                  parent_path: tuple = (), depth: int = None, members=None):
+        """
+        Recursively extract (member_path, stream) from any archive file. Each stream is a binary file object
+        of the member content and must be read before the next item is requested.
         Supports nested archives like a.zip::b.7z::c.txt.
 
         Parameters:
             file_path (Path): the archive file path
-            file_bytes (bytes | None): optional byte data if already read (for recursion)
-            parent_label (str): string for nested archive tracking like a.zip::b.7z::file.txt
+            file_stream (file object | None): optional binary stream of the archive (for recursion), it is closed
+                when the archive is done
+            parent_path (tuple): names of the nested archives from the outer archive down to this one,
+                like ('b.7z',) for a.zip::b.7z::file.txt
             depth (int): the depth value that is returned recursively
+            members (iterable | None): names of the zip members to read (all of them if None)
 
         Yields:
-            (str, str): tuple of full virtual path and decoded content text
+            (tuple, file object): names from the outer archive down to the member, like ('b.7z', 'file.txt')
+            (the parent path itself for single compressed files), and binary stream of the content
         """
 
-        file_ext = get_path_suffix(file_path)
-        label_prefix = (parent_label + str(file_path) + '::') if parent_label else '::'
+        import zipfile, py7zr, rarfile, gzip, bz2, lzma
+        from .archives import read_7z_members, open_tar, iter_tar_members
+
+        file_ext = get_path_suffix(file_path, False)
         if depth is None:
             depth = self.depth
 
         try:
-            # Decide the stream source: from disk or memory
-            file_stream = io.BytesIO(file_bytes) if file_bytes is not None else open(file_path, 'rb')
+            # Decide the stream source: from disk or from the parent archive
+            if file_stream is None:
+                file_stream = open(file_path, 'rb')
+
+            # At each recursion, subtract 1 from depth if it's set
+            new_depth = None if depth is None else depth - 1
 
             # Handle ZIP and RAR archives
             if file_ext in ('zip', 'rar'):
                 opener = {'zip': zipfile.ZipFile, 'rar': rarfile.RarFile}[file_ext]
                 with opener(file_stream) as f:
-                    for info in f.infolist():
-                        file_name = Path(info.filename)
-                        data = f.read(info)
-                        # At each recursion, subtract 1 from depth if it's set
-                        new_depth = None if depth is None else depth - 1
-
-                        # Check if this is a nested archive
-                        if get_path_suffix(file_name) in ARCHIVE_EXTS and (new_depth is None or new_depth >= 0):
-                            yield from self.extract_text_from_archive(file_name, data, label_prefix, new_depth)
-                        else:
-                            if self.archive_should_skip(
-                                    file_name,
-                                    'content',
-                                    not info.is_dir(),
-                                    info.is_dir(),
-                                    get_archive_path_size(info, file_ext)
-                            ):
+                    infos = f.infolist()
+                    if members is not None:
+                        members = set(members)
+                        infos = [info for info in infos if info.filename in members]
+
+                    for info, file_name, is_nested in self.plan_archive_members(infos, file_ext, new_depth):
+                        if self.cancel.is_cancelled():
+                            return
+                        with f.open(info) as member:
+                            if not is_nested:
+                                yield parent_path + (str(file_name),), member
                                 continue
+                            nested = spool_stream(member)
 
-                            text = try_decode(data)
-                            if text is not None:
-                                yield label_prefix + str(file_name), text
+                        yield from self.extract_text_from_archive(file_name, nested, parent_path + (str(file_name),),
+                                                                  new_depth)
             # Handle 7Z archives
             elif file_ext == '7z':
                 with py7zr.SevenZipFile(file_stream, mode='r') as archive:
-                    for info in archive.list():
-                        file_data = archive.read([info.filename]).get(info.filename)
-                        if file_data is None:
+                    plan = list(self.plan_archive_members(archive.list(), '7z', new_depth))
+                    members = read_7z_members(archive, [info.filename for info, _, _ in plan])
+
+                    for info, file_name, is_nested in plan:
+                        if self.cancel.is_cancelled():
+                            return
+                        member = members.pop(info.filename, None)
+                        if member is None:
                             continue
 
-                        file_name = Path(info.filename)
-                        data = file_data.read()
-                        new_depth = None if depth is None else depth - 1
-
-                        if get_path_suffix(file_name) in ARCHIVE_EXTS and (new_depth is None or new_depth >= 0):
-                            yield from self.extract_text_from_archive(file_name, data, label_prefix, new_depth)
+                        if is_nested:
+                            yield from self.extract_text_from_archive(file_name, member,
+                                                                      parent_path + (str(file_name),), new_depth)
                         else:
-                            if self.archive_should_skip(
-                                    file_name,
-                                    'content',
-                                    not info.is_directory,
-                                    info.is_directory,
-                                    get_archive_path_size(info, '7z')
-                            ):
-                                continue
-
-                            text = try_decode(data)
-                            if text is not None:
-                                yield label_prefix + str(file_name), text
+                            with member:
+                                yield parent_path + (str(file_name),), member
             # Handle TAR and compressed TAR formats
             elif file_ext in ('tar', 'tar.gz', 'tar.bz2', 'tar.xz'):
-                mode = {
-                    'tar': 'r',
-                    'tar.gz': 'r:gz',
-                    'tar.bz2': 'r:bz2',
-                    'tar.xz': 'r:xz'
-                }[file_ext]
-
-                with tarfile.open(fileobj=file_stream, mode=mode) as tf:
-                    for member in tf.getmembers():
+                # Read the archive with one sequential pass (members can't be read out of order)
+                with open_tar(file_stream) as tf:
+                    for member, file_name, is_nested in self.plan_archive_members(iter_tar_members(tf), file_ext,
+                                                                                  new_depth):
+                        if self.cancel.is_cancelled():
+                            return
                         f = tf.extractfile(member)
                         if f is None:
                             continue
 
-                        file_name = Path(member.name)
-                        data = f.read()
-                        new_depth = None if depth is None else depth - 1
-
-                        if get_path_suffix(file_name) in ARCHIVE_EXTS and (new_depth is None or new_depth >= 0):
-                            yield from self.extract_text_from_archive(file_name, data, label_prefix, new_depth)
+                        if is_nested:
+                            yield from self.extract_text_from_archive(file_name, spool_stream(f),
+                                                                      parent_path + (str(file_name),), new_depth)
                         else:
-                            if self.archive_should_skip(
-                                    file_name,
-                                    'content',
-                                    member.isfile(),
-                                    member.isdir(),
-                                    get_archive_path_size(member, file_ext)
-                            ):
-                                continue
-
-                            text = try_decode(data)
-                            if text is not None:
-                                yield label_prefix + str(file_name), text
+                            yield parent_path + (str(file_name),), f
             # Handle single compressed files like .gz, .bz2, .xz
             elif file_ext in ARCHIVE_EXTS[-3:]:
                 opener = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[file_ext]
                 with opener(file_stream, 'rb') as f:
-                    data = f.read()
-                    text = try_decode(data)
-                    if text is not None:
-                        yield file_ext, text
+                    yield parent_path, f
         except Exception:
             return
+        finally:
+            if file_stream is not None:
+                file_stream.close()
+
+    def archive_filters(self) -> tuple:
+        """Return the settings that decide which archive members are read (part of the archive cache key)"""
+        return (
+            self.depth, sorted(self.arc_ext), sorted(self.arc_ee), sorted(map(str, self.arc_inc)),
+            sorted(map(str, self.arc_exc)), self.arc_max, self.arc_min,
+            self.re_include and self.re_include.pattern, self.re_exclude and self.re_exclude.pattern
+        )
+
+    def archive_members(self, p_resolved: Path):
+        """
+        Yield (member_path, stream) of the members of an archive like extract_text_from_archive. If the archive
+        cache is enabled, the members are stored on the first search and read from the cache afterwards.
+        """
+        if self.arc_cache is not None:
+            key = self.arc_cache.key(p_resolved, self.archive_filters())
+            if key is not None:
+                members = self.arc_cache.get(key)
+                if members is None and self.arc_cache.put(key, self.extract_text_from_archive(p_resolved)):
+                    # An archive that was not read to the end because the search was stopped is not kept
+                    if self.cancel.is_cancelled():
+                        self.arc_cache.remove(key)
+                        return
+                    members = self.arc_cache.get(key)
+                if members is not None:
+                    yield from members
+                    return
+
+        yield from self.extract_text_from_archive(p_resolved)
+
+    def split_archive(self, p_resolved: Path) -> list:
+        """
+        Split the members of a large zip file into work units for content search, so they are searched
+        by several workers at the same time (zip members can be read independently of each other).
+
+        Returns:
+            list: tuples of member names (about ARCHIVE_UNIT_SIZE uncompressed each), or an empty list
+            if the archive should be searched by a single worker
+        """
+        import zipfile
+
+        new_depth = None if self.depth is None else self.depth - 1
+        try:
+            with zipfile.ZipFile(p_resolved) as f:
+                plan = list(self.plan_archive_members(f.infolist(), 'zip', new_depth))
+        except Exception:
+            return []
+
+        units = []
+        unit = []
+        unit_size = 0
+        for info, _, _ in plan:
+            unit.append(info.filename)
+            unit_size += info.file_size
+            if unit_size >= ARCHIVE_UNIT_SIZE:
+                units.append(tuple(unit))
+                unit = []
+                unit_size = 0
+        if unit:
+            units.append(tuple(unit))
+
+        return units if len(units) > 1 else []
+
+    def walk(self):
+        """
+        Walk the base path once (see walk_tree), without the content search index file.
 
-    def search(self, search_type: str):
-        """Main search function. search_type can be 'file', 'directory' or 'content'"""
+        Yields:
+            (os.DirEntry, Path): scandir entry (with cached type and stat data) and resolved path
+        """
+        for entry, p_resolved in walk_tree(self.base_path):
+            if entry.name != INDEX_NAME:
+                yield entry, p_resolved
+
+    def find_index(self):
+        """Find and load the content search index of the base path (see TrigramIndex.find)"""
+        return TrigramIndex.find(self.base_path)
+
+    def search_name(self, pattern, entry: os.DirEntry, p_resolved: Path, search_type: str, is_file: bool,
+                    is_dir: bool):
+        """
+        Search the name of a file/directory (and names inside it if it is an archive file).
+        Yields a NameMatch for each matching name as soon as it is found.
+        """
+        # Choose the path format based on the full_path setting (the path is only built for matches)
+        path = p_resolved if self.full_path else None
+        p_ext = get_path_suffix(p_resolved, is_dir)
+
+        if not (search_type == 'directory' and is_file):
+            # Match and find the parts to highlight with one scan of the name
+            matched, _, spans = match_text(pattern, entry.name)
+            if matched:
+                yield NameMatch(search_type, path or Path(entry.path), (), entry.name, spans)
+
+        # Search for files and directories name inside archive files if archive is active
+        if self.archive and p_ext in ARCHIVE_EXTS[:-3]:
+            for parent_path, name in self.extract_names_from_archive(p_resolved, search_type):
+                matched, _, spans = match_text(pattern, name.name)
+                if matched:
+                    yield NameMatch(search_type, path or Path(entry.path), parent_path + (str(name),), name.name,
+                                    spans)
+
+    def search_lines(self, pattern, raw_lines) -> list:
+        """Return a LineMatch for every (line number, offset, line bytes) that matches the pattern"""
+        result = []
+        for num, offset, raw_line in raw_lines:
+            if self.cancel.is_cancelled():
+                break
+            try:
+                # Decode the binary line and strip whitespace
+                line = raw_line.decode(self.encoding, self.errors).strip()
+            except UnicodeDecodeError:
+                # Skip lines that can't be decoded (with the 'strict' error handler)
+                continue
+
+            # Match, count and find the parts to highlight with one scan of the line
+            matched, count, spans = match_text(pattern, line)
+            if not matched:
+                continue
+
+            result.append(LineMatch(num, offset, line, spans, count))
+            # Only the file path is needed, so stop at the first matching line
+            if self.no_content:
+                break
+
+        return result
+
+    def content_result(self, path: Path, member_path: tuple, lines: list):
+        """Return the ContentMatch of a file (or archive member) with matching lines, or None if there are none"""
+        if not lines:
+            return None
+        return ContentMatch(path, member_path, [] if self.no_content else lines)
+
+    def search_content(self, patterns: tuple, file_path: Path, p_resolved: Path, members=None) -> list:
+        """
+        Process a single file for content search. patterns is the tuple returned by compile_pattern.
+        Files are memory-mapped, and archive members and files that can't be mapped are read in chunks
+        (see scan_stream), so memory use doesn't depend on the size of the file. Matching runs on the raw
+        bytes as far as possible and only candidate lines are decoded. Binary files are skipped (see is_binary).
+
+        members is a work unit of a split zip file (see split_archive): if it is given, only these members
+        are searched, and an empty tuple searches only the file itself.
+
+        Returns:
+            list: ContentMatch of the file and of each matching archive member
+        """
+        pattern, prefilter, anchor = patterns
+        matches = []
+        try:
+            # Choose the file path format based on the full_path setting
+            path = p_resolved if self.full_path else file_path
+
+            # First, check if the file is an archive, extract it from the archive and perform a search
+            if self.archive and get_path_suffix(p_resolved, False) in ARCHIVE_EXTS and members != ():
+                if members is None:
+                    member_streams = self.archive_members(p_resolved)
+                else:
+                    member_streams = self.extract_text_from_archive(p_resolved, members=members)
+
+                for member_path, stream in member_streams:
+                    if self.cancel.is_cancelled():
+                        break
+                    raw_lines = scan_stream(stream, anchor, skip_binary=True)
+                    result = self.content_result(path, member_path, self.search_lines(pattern, raw_lines))
+                    if result is not None:
+                        matches.append(result)
+
+                # The file itself is searched in its own work unit
+                if members:
+                    return matches
+
+            # Open the file in binary read mode
+            with open(file_path, 'rb') as f:
+                try:
+                    # Memory-map the file for efficient access
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # Empty files, pipes and special files can't be mapped, so read them in chunks
+                    raw_lines = scan_stream(f, anchor, skip_binary=True)
+                    result = self.content_result(path, (), self.search_lines(pattern, raw_lines))
+                    if result is not None:
+                        matches.append(result)
+                    return matches
+
+                with mm:
+                    if is_binary(mm):
+                        return matches
+
+                    # Reject the file with a bytes-level scan of the required literals before decoding anything
+                    if prefilter is not None and not prefilter(mm):
+                        return matches
+
+                    if anchor is not None:
+                        # Run the anchor over the whole file and only decode the lines around its hits
+                        raw_lines = scan_anchor_lines(mm, anchor)
+                    else:
+                        # Iterate over each line in the file
+                        raw_lines = scan_lines(mm)
+
+                    # If any matching lines were found, add the file and its matching lines to the results
+                    result = self.content_result(path, (), self.search_lines(pattern, raw_lines))
+                    if result is not None:
+                        matches.append(result)
+        except Exception:
+            pass
+
+        return matches
+
+    def compile_pattern(self):
+        """
+        Parse the query into an expression tree.
+
+        Returns:
+            (ExprNode, function | None, re.Pattern | None): the expression, a prefilter that rejects files which
+            don't contain the literals required by the expression and an anchor pattern that finds the lines
+            that may match (the lines it finds are always checked with the expression)
+        """
         pattern = parse_query_expression(self.query, self.expr, self.regex, self.whole_word, self.case_sensitive,
                                          self.fuzzy, self.fuzzy_level)
 
-        if search_type in ('file', 'directory'):
-            matches = []
-            for p in self.base_path.rglob('*'):
-                try:
-                    p_resolved = p.resolve()
-                except Exception:
-                    continue
-                # Skip if conditions fail
-                if self.should_skip(p_resolved, search_type):
-                    continue
+        # If expression is simple and is a single TermNode, we can use binary pattern
+        binary_pattern = None
+        if isinstance(pattern, TermNode):
+            try:
+                binary_pattern = pattern.get_binary_pattern(self.encoding)
+            except Exception:
+                binary_pattern = None
 
-                # Choose parent path based on full_path flag
-                p_parent = p_resolved.parent if self.full_path else p.parent
-                p_ext = get_path_suffix(p_resolved)
-
-                if pattern.evaluate(p.name) and not (search_type == 'directory' and p_resolved.is_file()):
-                    # Highlight matched query in the name
-                    highlighted_name = highlight_text(pattern, p.name, self.fuzzy)
-                    matches.append(f'{p_parent}\\{highlighted_name}')
-
-                # Search for files and directories name inside archive files if archive is active
-                if self.archive and p_ext in ARCHIVE_EXTS[:-3]:
-                    for label, name in self.extract_names_from_archive(p_resolved, search_type):
-                        if pattern.evaluate(name.name):
-                            highlighted_name = highlight_text(pattern, name.name, self.fuzzy)
-                            matches.append(f'{p_parent}\\{p.name}{label}{name.parent}\\{highlighted_name}')
-        else:  # content search
-            # Use dictionary: key: file path (colored), value: list of line matches
-            matches = {} if not self.no_content else set()
-
-            # If expression is simple and is a single TermNode, we can use binary pattern
-            binary_pattern = None
-            if isinstance(pattern, TermNode):
-                try:
-                    binary_pattern = pattern.get_binary_pattern()
-                except Exception:
-                    binary_pattern = None
+        requirement = pattern.required_literals()
+        # The binary pattern already checks the whole file and finds every line that may match
+        prefilter = compile_prefilter(requirement, self.encoding) if binary_pattern is None else None
+        anchor = compile_anchor(requirement, self.encoding) if binary_pattern is None else binary_pattern
 
-            def process_file(file_path: Path):
-                """Process a single file for content search"""
-                try:
-                    # Avoid empty files for mmap
-                    if file_path.stat().st_size == 0:
-                        return
+        return pattern, prefilter, anchor
 
-                    # Choose the file path format based on the full_path setting
-                    file_label = str(file_path.resolve()) if self.full_path else str(file_path)
+    def search_content_batch(self, patterns: tuple, batch: list) -> tuple:
+        """
+        Process a batch of (file_path, p_resolved, members) for content search and return all of their results
+        (members is None, or a work unit of a split archive, see search_content) with the number of files
+        that were searched to the end before the search was cancelled
+        """
+        matches = []
+        searched = 0
+        for file_path, p_resolved, members in batch:
+            if self.cancel.is_cancelled():
+                break
+            matches.extend(self.search_content(patterns, file_path, p_resolved, members))
+            if not self.cancel.is_cancelled():
+                searched += 1
+        return matches, searched
+
+    def iter_search(self, *search_types: str):
+        """
+        Search generator. search_types can be any of 'file', 'directory' and 'content'.
+        The tree is walked only once and each entry is sent to every requested search type.
+        Results are yielded as soon as each name or file is done, and only a bounded number of files
+        are processed at the same time, so memory does not grow with the size of the tree.
 
-                    # First, check if the file is an archive, extract it from the archive and perform a search
-                    if self.archive and get_path_suffix(file_path) in ARCHIVE_EXTS:
-                        for fname, content in self.extract_text_from_archive(file_path):
-                            if not pattern.evaluate(content) and not self.expr:
-                                continue
+        Content search runs in a thread pool, or in a process pool if jobs is set. Worker processes
+        get batches of files and compile the expression once (see init_worker). The members of large
+        zip files are split into work units of their own (see split_archive), so one archive can use
+        every worker.
 
-                            # Change file_label for archive files (zip, rar, 7z, tar)
-                            if fname not in ARCHIVE_EXTS[-3:]:
-                                file_label += fname
+        If timeout is set, the walker, the workers and the archive readers stop when it has passed, the
+        matches found so far are still yielded, and self.coverage tells how much of the tree was searched.
 
-                            if self.no_content and not self.expr:
-                                matches.add(click.style(file_label, fg='cyan'))
-                                continue
+        Yields:
+            NameMatch | ContentMatch: each result (see results.py), with its type in search_type
+        """
+        patterns = self.compile_pattern()
+        pattern = patterns[0]
+
+        # Use the content search index (if the tree has one) to skip files that can't match
+        index = candidates = None
+        if 'content' in search_types:
+            index = self.find_index()
+            if index is not None:
+                candidates = index.candidates(pattern.required_literals(), self.encoding)
+
+        # The token is created before the worker processes, so they get the same deadline and the event
+        # that stops them when the search is closed early
+        event = None
+        if 'content' in search_types and self.jobs is not None:
+            from multiprocessing import Event
+            event = Event()
+        self.cancel = CancelToken(self.timeout, event)
+        coverage = self.coverage = Coverage()
+
+        max_workers = self.jobs or os.cpu_count() or 1
+        executor = None
+        if 'content' in search_types:
+            from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+            if self.jobs is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+            else:
+                executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(self,))
+        batch_size = 1 if self.jobs is None else PROCESS_BATCH_SIZE
+        batch = []
+        # Finished batches are put in this queue by the workers
+        done = queue.SimpleQueue()
+        pending = 0
+
+        def submit(work):
+            """Send a batch of files to the executor"""
+            if self.jobs is None:
+                future = executor.submit(self.search_content_batch, patterns, work)
+            else:
+                future = executor.submit(search_content_batch, work)
+            future.add_done_callback(done.put)
+            coverage.files += len(work)
 
-                            lines = []
-                            for num, line in enumerate(content.splitlines(), 1):
-                                if not pattern.evaluate(line):
-                                    continue
-
-                                if self.no_content and self.expr:
-                                    matches.add(click.style(file_label, fg='cyan'))
-                                    continue
-
-                                count = pattern.count_matches(line) if isinstance(pattern, TermNode) else 0
-                                # Highlight the matching parts in green
-                                highlighted = highlight_text(pattern, line.strip(), self.fuzzy)
-                                # Show a note if the pattern repeats 3 or more times
-                                count_query = f' - Repeated {count} times' if count >= 3 else ''
-                                # Format the output line with line number and highlighted matches
-                                lines.append(
-                                    click.style(f'Line {num}{count_query}: ', fg='magenta') + highlighted
-                                )
-
-                            if lines:
-                                matches[click.style(file_label, fg='cyan')] = lines
-
-                    # Open the file in binary read mode
-                    with open(file_path, 'rb') as f:
-                        # Memory-map the file for efficient access
-                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                            if binary_pattern is not None:
-                                if not binary_pattern.search(mm):
-                                    return
-                            else:
-                                # fallback: decode whole file for complex expressions
-                                try:
-                                    content = mm.read().decode('utf-8')
-                                except UnicodeDecodeError:
-                                    return
-
-                                if not pattern.evaluate(content) and not self.expr:
-                                    return
-
-                            # Avoid searching through the entire file content if the fast-content flag is True
-                            if self.no_content and not self.expr:
-                                matches.add(click.style(file_label, fg='cyan'))
-                                return
-
-                            lines = []
-                            mm.seek(0)  # Move the cursor to the beginning of the file
-
-                            # Iterate over each line in the file
-                            for num, line in enumerate(iter(mm.readline, b''), 1):
-                                try:
-                                    # Decode the binary line as UTF-8 and strip whitespace
-                                    line_decoded = line.decode('utf-8').strip()
-                                except UnicodeDecodeError:
-                                    # Skip lines that can't be decoded
-                                    continue
-
-                                # If the pattern matches in the decoded line
-                                if pattern.evaluate(line_decoded):
-                                    if self.no_content and self.expr:
-                                        matches.add(click.style(file_label, fg='cyan'))
-                                        return
-                                    count = pattern.count_matches(line_decoded) if isinstance(pattern, TermNode) else 0
-                                    # Highlight the matching parts in green
-                                    highlighted = highlight_text(pattern, line_decoded, self.fuzzy)
-                                    # Show a note if the pattern repeats 3 or more times
-                                    count_query = f' - Repeated {count} times' if count >= 3 else ''
-                                    # Format the output line with line number and highlighted matches
-                                    lines.append(
-                                        click.style(f'Line {num}{count_query}: ', fg='magenta') + highlighted
-                                    )
-
-                            # If any matching lines were found
-                            if lines:
-                                # Add the file and its matching lines to the results
-                                matches[click.style(file_label, fg='cyan')] = lines
-                except Exception:
-                    return
+        def finish(future):
+            """Return the matches of a finished batch and count its searched files"""
+            matches, searched = future.result()
+            coverage.searched += searched
+            return matches
+
+        try:
+            for entry, p_resolved in self.walk():
+                if self.cancel.is_cancelled():
+                    break
+                coverage.paths += 1
+                try:
+                    is_dir = entry.is_dir()
+                    is_file = entry.is_file()
+                    p_size = entry.stat().st_size / 1_048_576  # Convert size to MB
+                except OSError:
+                    # If path is inaccessible, skip it.
+                    continue
 
-            # Filter files before processing
-            files_to_process = {
-                p for p in self.base_path.rglob('*') if not self.should_skip(p.resolve(), 'content')
-            }
+                for search_type in search_types:
+                    # Skip if conditions fail
+                    if self.should_skip(p_resolved, search_type, is_file, is_dir, p_size):
+                        continue
+
+                    if search_type == 'content':
+                        # Avoid empty files for mmap and files excluded by the index
+                        # (archive files are never excluded because their members are searched)
+                        if not p_size or (
+                                candidates is not None
+                                and index.excludes(p_resolved, entry.stat(), candidates)
+                                and not (self.archive and get_path_suffix(p_resolved, False) in ARCHIVE_EXTS)
+                        ):
+                            continue
 
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                executor.map(process_file, files_to_process)
+                        units = []
+                        if self.archive and self.arc_cache is None and p_size >= ARCHIVE_SPLIT_SIZE \
+                                and get_path_suffix(p_resolved, False) == 'zip':
+                            units = self.split_archive(p_resolved)
 
-        self.result = matches
-        return self
+                        if units:
+                            # Send the file itself and each unit of its members as separate work
+                            for unit in [(), *units]:
+                                submit([(Path(entry.path), p_resolved, unit)])
+                                pending += 1
+                            continue
 
-    def echo(self, title: str, result_name: str) -> int:
+                        batch.append((Path(entry.path), p_resolved, None))
+                        if len(batch) >= batch_size:
+                            submit(batch)
+                            batch = []
+                            pending += 1
+                    else:
+                        yield from self.search_name(pattern, entry, p_resolved, search_type, is_file, is_dir)
+
+                # Wait for a worker if too many batches are in progress, then yield every finished batch
+                while pending >= max_workers * 4 or not done.empty():
+                    pending -= 1
+                    yield from finish(done.get())
+
+            if batch and not self.cancel.cancelled:
+                submit(batch)
+                pending += 1
+
+            while pending:
+                pending -= 1
+                yield from finish(done.get())
+
+            # Anything stopped in this process sets cancelled, and worker processes leave files unsearched
+            coverage.complete = not self.cancel.cancelled and coverage.searched == coverage.files
+        finally:
+            # Stop the workers if the consumer closed the generator early
+            self.cancel.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def search(self, *search_types: str):
         """
-        Display the search results with a title.
-        Returns the count of results.
+        Main search function. search_types can be any of 'file', 'directory' and 'content'.
+        All results are collected in self.result (a list for each search type) before they are displayed.
         """
-        count_result = 0
-
-        if self.result:
-            click.echo(click.style(f'\n{title}:\n', fg='yellow'))
-            if isinstance(self.result, dict):
-                # For content search results
-                for key, value in self.result.items():
-                    click.echo(key)
-                    click.echo('\n'.join(value) + '\n')
-                    count_result += len(value)
+        self.result = {search_type: [] for search_type in search_types}
+        # Content results are keyed by their path, so a file (or archive member) is listed only once
+        contents = {}
+
+        for result in self.iter_search(*search_types):
+            if result.search_type == 'content':
+                contents[result.path, result.member_path] = result
             else:
-                # For file/directory search results
-                count_result = len(self.result)
-                click.echo('\n'.join(self.result))
+                self.result[result.search_type].append(result)
+
+        if 'content' in search_types:
+            self.result['content'] = list(contents.values())
+
+        return self
+
+
+def init_worker(search_instance: Search):
+    """Initialize a content search worker process: compile the expression only once per process"""
+    global _worker
+    _worker = (search_instance, search_instance.compile_pattern())
 
-            if count_result >= 3:
-                click.echo(click.style(f'\n{count_result} results found for {result_name}', fg='blue'))
 
-        return count_result
+def search_content_batch(batch: list) -> tuple:
+    """Process a batch of files for content search inside a worker process"""
+    search_instance, patterns = _worker
+    return search_instance.search_content_batch(patterns, batch)
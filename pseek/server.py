@@ -0,0 +1,400 @@
+import os, sys, json, stat, time, click, signal, struct, socket, threading, socketserver, ctypes, ctypes.util
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import asdict
+from .searcher import Search
+from .index import INDEX_NAME, TrigramIndex
+from .results import NameMatch, LineMatch, ContentMatch, Coverage
+from .utils import USER_CACHE_DIR, walk_tree, user_cache_dir
+
+# Default socket of the search server, in a directory private to the user (not in the shared temporary directory,
+# where another user could create it first)
+SOCKET_PATH = os.environ.get('PSEEK_SOCKET') or os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or USER_CACHE_DIR, 'pseek.sock'
+)
+# Version of the messages exchanged with the server (one JSON object per line)
+PROTOCOL_VERSION = 1
+# Seconds between two walks of the searched trees when changes are not watched with inotify
+POLL_INTERVAL = 2.0
+# Number of compiled queries kept by the server
+PATTERN_CACHE_SIZE = 256
+
+# inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+    | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class TreeWatcher:
+    """
+    Directory listings of the searched trees kept in memory (see walk_tree), so a search doesn't list and stat
+    the whole tree again. On Linux every listed directory is watched with inotify and its listing is dropped
+    when it changes. Elsewhere, or when inotify can't watch every directory (see
+    /proc/sys/fs/inotify/max_user_watches), the searched trees are walked again in the background every
+    POLL_INTERVAL seconds instead, so changes are seen after at most that long.
+    """
+
+    def __init__(self, poll: bool = False):
+        self.listings = {}
+        # Change counters of the directories that changed, and of the events that drop many listings at once
+        # (increased before the listings are dropped, see walk_tree)
+        self.generations = {}
+        self.epoch = 0
+        # Searched base paths (walked again when polling)
+        self.roots = set()
+        # inotify watch descriptor to directory path
+        self.watches = {}
+        self.polling = False
+        self.libc = None
+        self.fd = -1
+
+        if not poll and sys.platform.startswith('linux'):
+            try:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+            except (OSError, AttributeError):
+                self.fd = -1
+
+        if self.fd < 0:
+            self.start_polling()
+        else:
+            threading.Thread(target=self.read_events, daemon=True).start()
+
+    def walk(self, base_path: Path):
+        """Walk a tree like walk_tree, with the directory listings kept in memory"""
+        self.roots.add(str(base_path))
+        return walk_tree(base_path, self.listings, self.watch, self.generation)
+
+    def generation(self, dir_path: str) -> tuple:
+        """Return the change counters of a directory"""
+        return self.epoch, self.generations.get(dir_path, 0)
+
+    def watch(self, dir_path: str):
+        """Watch a directory before it is listed"""
+        if self.polling:
+            return
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            # Out of watches (or the directory is gone): watching would miss changes, so poll instead
+            if ctypes.get_errno() != 2:  # ENOENT
+                self.start_polling()
+            return
+        self.watches[wd] = dir_path
+
+    def start_polling(self):
+        """Stop relying on inotify and walk the searched trees again every POLL_INTERVAL seconds"""
+        if not self.polling:
+            self.polling = True
+            threading.Thread(target=self.poll, daemon=True).start()
+
+    def poll(self):
+        """Replace the listings with fresh ones (with their stat data already read) every POLL_INTERVAL seconds"""
+        while True:
+            time.sleep(POLL_INTERVAL)
+            listings = {}
+            for root in list(self.roots):
+                for entry, _ in walk_tree(Path(root), listings):
+                    try:
+                        entry.stat()
+                    except OSError:
+                        pass
+            self.listings = listings
+
+    def read_events(self):
+        """Read inotify events and drop the listings of the directories that changed"""
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                return
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                name = os.fsdecode(data[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + length].rstrip(b'\0'))
+                pos += EVENT_HEADER.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so every listing may be out of date
+                    self.epoch += 1
+                    self.listings.clear()
+                    continue
+
+                dir_path = self.watches.get(wd)
+                if dir_path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was removed, so its watch is gone
+                    del self.watches[wd]
+
+                self.generations[dir_path] = self.generations.get(dir_path, 0) + 1
+                self.listings.pop(dir_path, None)
+                # A sub directory was removed, moved or created: drop the listings of everything under it
+                if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE):
+                    self.drop_tree(os.path.join(dir_path, name))
+
+    def drop_tree(self, dir_path: str):
+        """Drop the listings of a directory and of every directory under it"""
+        prefix = dir_path + os.sep
+        # Directories under it that are being listed now are not in listings yet
+        self.epoch += 1
+        for path in list(self.listings):
+            if path == dir_path or path.startswith(prefix):
+                self.listings.pop(path, None)
+
+
+# Unix domain sockets are missing on some platforms (e.g. Windows), where the server is never started
+# (see check_unix_sockets), but the module can still be imported
+UnixStreamServer = getattr(socketserver, 'UnixStreamServer', socketserver.TCPServer)
+
+
+def check_unix_sockets(feature: str):
+    """Exit with an error if Unix domain sockets are not supported"""
+    if not hasattr(socket, 'AF_UNIX'):
+        click.echo(click.style(f'{feature} needs Unix domain sockets, which are not supported here', fg='red'))
+        sys.exit(1)
+
+
+class SearchServer(socketserver.ThreadingMixIn, UnixStreamServer):
+    """
+    Search server on a Unix socket. Every search runs in its own thread and reuses the warm state of the
+    server: the walked trees (see TreeWatcher), the compiled queries and the loaded indexes.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, poll: bool = False):
+        self.watcher = TreeWatcher(poll)
+        # Compiled queries (see Search.compile_pattern), least recently used first
+        self.patterns = OrderedDict()
+        self.patterns_lock = threading.Lock()
+        # Index root to (mtime of the index file, loaded index)
+        self.indexes = {}
+        super().__init__(socket_path, SearchHandler)
+
+    def compile_pattern(self, search_instance: Search):
+        """Return the compiled query of a search, compiled only the first time it is used"""
+        key = (search_instance.query, search_instance.expr, search_instance.regex, search_instance.whole_word,
+               search_instance.case_sensitive, search_instance.fuzzy, search_instance.fuzzy_level,
+               search_instance.encoding)
+        with self.patterns_lock:
+            patterns = self.patterns.get(key)
+            if patterns is not None:
+                self.patterns.move_to_end(key)
+                return patterns
+
+        patterns = Search.compile_pattern(search_instance)
+        with self.patterns_lock:
+            self.patterns[key] = patterns
+            if len(self.patterns) > PATTERN_CACHE_SIZE:
+                self.patterns.popitem(last=False)
+        return patterns
+
+    def find_index(self, path: Path):
+        """Find the index of path like TrigramIndex.find, loading it again only when the index file changes"""
+        path = path.resolve()
+        for root in (path, *path.parents):
+            try:
+                mtime = (root / INDEX_NAME).stat().st_mtime_ns
+            except OSError:
+                continue
+
+            cached = self.indexes.get(root)
+            if cached is None or cached[0] != mtime:
+                cached = self.indexes[root] = (mtime, TrigramIndex.load(root))
+            return cached[1]
+        return None
+
+
+class ServerSearch(Search):
+    """Search that runs inside the server and uses its warm state"""
+
+    def __init__(self, server: SearchServer, **options):
+        super().__init__(**options)
+        self.server = server
+
+    def walk(self):
+        for entry, p_resolved in self.server.watcher.walk(self.base_path):
+            if entry.name != INDEX_NAME:
+                yield entry, p_resolved
+
+    def compile_pattern(self):
+        return self.server.compile_pattern(self)
+
+    def find_index(self):
+        return self.server.find_index(self.base_path)
+
+
+class SearchHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one search: read the request (search types and Search options), then send each result as soon
+    as it is found and a last message with done (and the coverage of the search) or error. The search stops
+    if the client goes away.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get('version') != PROTOCOL_VERSION:
+                raise ValueError('the client and the server have different versions of pseek')
+
+            # Worker processes are not used inside the server, content search runs in threads
+            search_instance = ServerSearch(self.server, **dict(request['options'], jobs=None))
+            for result in search_instance.iter_search(*request['types']):
+                self.send(encode_result(result))
+            self.send({'done': True, 'coverage': asdict(search_instance.coverage)})
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            return  # The client went away
+        except ValueError as e:
+            # The query, a regex or an option is not valid
+            error = str(e)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+
+        try:
+            self.send({'error': error})
+        except OSError:
+            pass
+
+    def send(self, message: dict):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+
+
+class RemoteSearch(Search):
+    """Search that runs in a search server (see SearchServer) and streams its results back"""
+
+    def __init__(self, socket_path: str = SOCKET_PATH, **options):
+        super().__init__(**options)
+        self.socket_path = socket_path
+        # Paths are sent as absolute paths, because the server doesn't run in the current directory
+        self.options = dict(
+            options,
+            base_path=os.path.abspath(self.base_path),
+            include=[str(p) for p in self.include],
+            exclude=[str(p) for p in self.exclude]
+        )
+
+    def iter_search(self, *search_types: str):
+        """Send the search to the server and yield its results (see Search.iter_search)"""
+        check_unix_sockets('--server')
+        if not is_own_socket(self.socket_path):
+            click.echo(click.style(f'No pseek server of the current user is running on {self.socket_path} '
+                                   f'(start one with: pseek serve start)', fg='red'))
+            sys.exit(1)
+
+        request = {'version': PROTOCOL_VERSION, 'types': search_types, 'options': self.options}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                click.echo(click.style(f'No pseek server is running on {self.socket_path} '
+                                       f'(start one with: pseek serve start)', fg='red'))
+                sys.exit(1)
+
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                for line in f:
+                    message = json.loads(line)
+                    if message.get('done'):
+                        self.coverage = Coverage(**message['coverage'])
+                        return
+                    if 'error' in message:
+                        click.echo(click.style(f"Server error: {message['error']}", fg='red'))
+                        sys.exit(1)
+
+                    result = decode_result(message)
+                    # Show paths relative to the base path like a local search
+                    if not self.full_path:
+                        result.path = self.base_path / result.path.relative_to(self.options['base_path'])
+                    yield result
+
+        click.echo(click.style('The pseek server stopped before the search ended', fg='red'))
+        sys.exit(1)
+
+
+def encode_result(result) -> dict:
+    """Convert a result to a JSON message"""
+    if isinstance(result, ContentMatch):
+        return {'search_type': 'content', 'path': str(result.path), 'member_path': result.member_path,
+                'lines': [(line.line_num, line.offset, line.text, line.spans, line.count) for line in result.lines]}
+    return {'search_type': result.search_type, 'path': str(result.path), 'member_path': result.member_path,
+            'name': result.name, 'spans': result.spans}
+
+
+def decode_result(message: dict):
+    """Convert a JSON message back to a result"""
+    if message['search_type'] == 'content':
+        lines = [LineMatch(line_num, offset, text, [tuple(span) for span in spans], count)
+                 for line_num, offset, text, spans, count in message['lines']]
+        return ContentMatch(Path(message['path']), tuple(message['member_path']), lines)
+    return NameMatch(message['search_type'], Path(message['path']), tuple(message['member_path']),
+                     message['name'], [tuple(span) for span in message['spans']])
+
+
+def is_own_socket(path: str) -> bool:
+    """Return True if path is a Unix socket (not a symlink to one) owned by the current user"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and (not hasattr(os, 'getuid') or st.st_uid == os.getuid())
+
+
+def run_server(socket_path: str = SOCKET_PATH, poll: bool = False):
+    """Run a search server until it is interrupted"""
+    check_unix_sockets('pseek serve start')
+    if Path(socket_path).parent == USER_CACHE_DIR:
+        user_cache_dir()
+
+    if os.path.lexists(socket_path):
+        # Never remove a file that isn't a socket of the current user
+        if not is_own_socket(socket_path):
+            click.echo(click.style(f'{socket_path} exists and is not a socket of the current user', fg='red'))
+            sys.exit(1)
+
+        # Don't replace the socket of a running server, but remove the one left by a stopped server
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                os.remove(socket_path)
+            else:
+                click.echo(click.style(f'A pseek server is already running on {socket_path}', fg='red'))
+                sys.exit(1)
+
+    # Only the current user can connect, because searches read files with the server's permissions
+    old_umask = os.umask(0o077)
+    try:
+        server = SearchServer(socket_path, poll)
+    finally:
+        os.umask(old_umask)
+
+    # Remove the socket when the server is stopped with SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    watching = 'polling' if server.watcher.polling else 'inotify'
+    click.echo(click.style(f'pseek server listening on {socket_path} (watching changes with {watching})', fg='green'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
@@ -1,16 +1,88 @@
-import re, sys, click, shutil, rarfile, platform
+import os, re, sys, time, click, shutil, tempfile
 from pathlib import Path
 
 EXTENSIONS_PATH = Path(__file__).parent / "extensions"
+# Size of the pieces used to count newlines in large buffers
+NEWLINE_CHUNK_SIZE = 4 * 1_048_576
+# Nested archives and 7z members are kept in memory up to this size, larger ones are spooled to a temporary file
+SPOOL_MAX_SIZE = 16 * 1_048_576
+# Seconds between two checks of the event of a CancelToken (it is shared with worker processes, so checking it is slow)
+CANCEL_CHECK_INTERVAL = 0.05
+# Directory of the files cached by pseek (only readable by the user, see user_cache_dir)
+USER_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'pseek'
+
+# Valid multi-part extensions (e.g. tar.gz), loaded once for constant time lookups
+with open(EXTENSIONS_PATH, "r") as _f:
+    EXTENSIONS = frozenset(line.strip() for line in _f)
 
 
 def compile_regex(txt, flags=0):
+    """Compile a regex (None stays None). Raises ValueError if it is not valid."""
     if txt is not None:
         try:
             return re.compile(txt, flags)
         except re.error as e:
-            click.echo(click.style(f"Regex compile error: {e}", fg='red'))
-            sys.exit(1)
+            raise ValueError(f"Regex compile error: {e}") from None
+
+
+def validate_encoding(encoding: str):
+    """Raise ValueError if the encoding can't be used for content search"""
+    ascii_chars = ''.join(map(chr, range(128)))
+    try:
+        # Lines are split and literals are matched on the raw bytes, so the encoding must be ASCII-compatible
+        supported = ascii_chars.encode(encoding) == ascii_chars.encode('ascii')
+    except (LookupError, UnicodeError):
+        supported = False
+    if not supported:
+        raise ValueError(f"Unsupported encoding: {encoding} (it must be ASCII-compatible, e.g. utf-8, latin-1, cp1252)")
+
+
+def check_encoding(encoding: str):
+    """Exit with an error if the encoding can't be used for content search"""
+    try:
+        validate_encoding(encoding)
+    except ValueError as e:
+        click.echo(click.style(str(e), fg='red'))
+        sys.exit(1)
+
+
+class CancelToken:
+    """
+    Cooperative cancellation of a search: the walker, the content search workers and the archive readers
+    check it often and stop early when it is cancelled (by cancel() or when the timeout has passed).
+    The deadline is kept as a monotonic time, so a copy sent to a worker process expires at the same moment.
+    A copy can't see cancel() of another process, so cancel() also sets the event (a multiprocessing.Event
+    shared with the worker processes) if it is given, and copies check it every CANCEL_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, timeout: float = None, event=None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.event = event
+        self.next_check = 0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.event is not None:
+            self.event.set()
+
+    def is_cancelled(self) -> bool:
+        if self.cancelled or (self.deadline is None and self.event is None):
+            return self.cancelled
+
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self.cancelled = True
+        elif self.event is not None and now >= self.next_check:
+            self.next_check = now + CANCEL_CHECK_INTERVAL
+            self.cancelled = self.event.is_set()
+        return self.cancelled
+
+
+def user_cache_dir() -> Path:
+    """Create the cache directory of pseek (private to the user) if needed and return it"""
+    USER_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return USER_CACHE_DIR
 
 
 def get_archive_path_size(info, file_type: str) -> float:
@@ -23,12 +95,30 @@ def get_archive_path_size(info, file_type: str) -> float:
         return info.size / 1_048_576
 
 
-def try_decode(data: bytes):
-    """Try decoding byte data to UTF-8 text. Return None if decoding fails."""
-    try:
-        return data.decode('utf-8')
-    except UnicodeDecodeError:
-        return None
+def get_archive_member(info, file_type: str) -> tuple:
+    """Return (name, is_file, is_dir) of an archive member from its header"""
+    if file_type in ('zip', 'rar'):
+        return Path(info.filename), not info.is_dir(), info.is_dir()
+    elif file_type == '7z':
+        return Path(info.filename), not info.is_directory, info.is_directory
+    elif file_type in ('tar', 'tar.gz', 'tar.bz2', 'tar.xz'):
+        return Path(info.name), info.isfile(), info.isdir()
+
+
+def count_newlines(buf, start: int, end: int) -> int:
+    """Count the newlines in buf[start:end] (bytes or mmap), copying only a chunk of it at a time"""
+    count = 0
+    for pos in range(start, end, NEWLINE_CHUNK_SIZE):
+        count += buf[pos:min(pos + NEWLINE_CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def spool_stream(stream):
+    """Copy a binary stream to a spooled temporary file (see SPOOL_MAX_SIZE) and rewind it"""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    shutil.copyfileobj(stream, spool)
+    spool.seek(0)
+    return spool
 
 
 def check_rar_backend(archive_enabled: bool, tool_path: str, backend: str):
@@ -53,6 +143,8 @@ def check_rar_backend(archive_enabled: bool, tool_path: str, backend: str):
         unar_path = shutil.which('unar')
 
         if not any((unrar_path, bsdtar_path, sevenzip_path, unar_path)) and not backend_path.exists():
+            import platform
+
             system = platform.system()
             if system == 'Linux':
                 install_tip = "sudo apt install unrar"
@@ -70,6 +162,8 @@ def check_rar_backend(archive_enabled: bool, tool_path: str, backend: str):
                 fg='yellow'
             )
         elif backend_path.exists():
+            import rarfile
+
             with open(backend_path, 'r') as f:
                 b, tool = f.read().split(':', 1)
 
@@ -84,13 +178,71 @@ def check_rar_backend(archive_enabled: bool, tool_path: str, backend: str):
                 rarfile.SEVENZIP_TOOL = tool
 
 
-def get_path_suffix(path: Path) -> str:
-    """ If multiple file suffixes are valid, return them, otherwise return only the last suffix """
-    if path.is_dir():
+def get_path_suffix(path: Path, is_dir: bool = None) -> str:
+    """
+    If multiple file suffixes are valid, return them, otherwise return only the last suffix.
+    Pass is_dir if it is already known to avoid a stat call (it must be given for paths inside archive files).
+    """
+    if is_dir is None:
+        is_dir = path.is_dir()
+    if is_dir:
         return ''
-    
-    with open(EXTENSIONS_PATH, "r") as f:
-        extensions = [line.strip() for line in f]
-    
-    file_suffixes = ''.join(path.suffixes)[1:].lower()
-    return file_suffixes if file_suffixes in extensions else path.suffix[1:].lower()
+
+    suffixes = path.suffixes
+    if not suffixes:
+        return ''
+
+    file_suffixes = ''.join(suffixes)[1:].lower()
+    return file_suffixes if file_suffixes in EXTENSIONS else suffixes[-1][1:].lower()
+
+
+def walk_tree(base_path: Path, listings: dict = None, watch=None, generation=None):
+    """
+    Walk a directory tree once using os.scandir.
+    Symlinked directories are not followed (like Path.rglob).
+
+    Parameters:
+        base_path (Path): directory to walk
+        listings (dict | None): directory path to its listing, reused instead of listing the directory
+            again and filled with the directories that are listed (to keep a walked tree in memory)
+        watch (function | None): called with each directory path before it is listed into listings
+        generation (function | None): returns a value of a directory path that changes when the directory
+            changes (from another thread), the listing is stored only if it didn't change during the listing
+
+    Yields:
+        (os.DirEntry, Path): scandir entry (with cached type and stat data) and resolved path
+    """
+    stack = [(str(base_path), base_path.resolve())]
+    while stack:
+        dir_path, dir_resolved = stack.pop()
+        listing = listings.get(dir_path) if listings is not None else None
+        if listing is None:
+            before = generation(dir_path) if generation is not None else None
+            if watch is not None:
+                watch(dir_path)
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = list(it)
+            except OSError:
+                continue  # skip inaccessible directories
+
+            listing = []
+            for entry in entries:
+                try:
+                    # Only symlinks need a real resolve, other paths are built from the resolved parent
+                    p_resolved = Path(entry.path).resolve() if entry.is_symlink() else dir_resolved / entry.name
+                    listing.append((entry, p_resolved, entry.is_dir(follow_symlinks=False)))
+                except OSError:
+                    continue
+            # A change during the listing may be missing from it, so the directory is listed again next time
+            if listings is not None and (generation is None or generation(dir_path) == before):
+                listings[dir_path] = listing
+
+        sub_dirs = []
+        for entry, p_resolved, is_dir in listing:
+            if is_dir:
+                sub_dirs.append((entry.path, p_resolved))
+            yield entry, p_resolved
+
+        # Reverse to visit sub directories in scandir order
+        stack.extend(reversed(sub_dirs))